@@ -0,0 +1,231 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from inbox_cache import INBOX_CACHE_ROWS, inbox
+from user_cache import registry
+
+logger = logging.getLogger(__name__)
+
+# Writes are queued to one worker thread per shard, so SQLite commits and fsyncs
+# never run on the event loop and writes to each shard stay serialized.
+_executors = {}
+
+# Reads run on a pool of reader threads shared by all shards, each with its own
+# connection. In WAL mode they don't wait for a commit or fsync in progress.
+DB_READERS = 4
+_readers = None
+
+# Question and answer inserts wait at most this long to be committed together
+GROUP_COMMIT_DELAY = 0.005  # seconds
+GROUP_COMMIT_MAX_ROWS = 100
+
+
+def _get_executor(shard: int = 0) -> ThreadPoolExecutor:
+    """Return a shard's DB worker executor, starting it if needed."""
+    executor = _executors.get(shard)
+    if executor is None:
+        executor = _executors[shard] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-worker-{shard}")
+    return executor
+
+
+async def run_on(shard: int, func, *args, **kwargs):
+    """Run a synchronous database function on a shard's DB worker thread and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(shard), functools.partial(func, *args, **kwargs))
+
+
+async def run(func, *args, **kwargs):
+    """Run a synchronous database function on the DB worker thread of shard 0, which holds everything but questions."""
+    return await run_on(0, func, *args, **kwargs)
+
+
+def _get_readers() -> ThreadPoolExecutor:
+    """Return the reader pool, starting it if needed."""
+    global _readers
+    if _readers is None:
+        _readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-reader")
+    return _readers
+
+
+async def read(func, *args, **kwargs):
+    """Run a synchronous database function that only reads on the reader pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_readers(), functools.partial(func, *args, **kwargs))
+
+
+class GroupCommitWriter:
+    """
+    Collects question and answer inserts for one shard for up to max_delay seconds or
+    max_rows rows and commits them in one transaction on the shard's DB worker thread.
+    Every caller still gets its own id back.
+    """
+
+    def __init__(self, shard: int = 0, max_delay: float = GROUP_COMMIT_DELAY, max_rows: int = GROUP_COMMIT_MAX_ROWS):
+        self.shard = shard
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self._pending = []
+        self._timer = None
+        self._commits = set()
+
+    async def submit(self, kind: str, *args):
+        """Queue a write from database.WRITERS and wait for its id."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((kind, args, future))
+        if len(self._pending) >= self.max_rows:
+            self._start_commit()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_commit)
+        return await future
+
+    async def flush(self):
+        """Commit everything queued so far and wait for it."""
+        self._start_commit()
+        if self._commits:
+            await asyncio.gather(*self._commits, return_exceptions=True)
+
+    def _start_commit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._commit(batch))
+        self._commits.add(task)
+        task.add_done_callback(self._commits.discard)
+
+    async def _commit(self, batch: list):
+        try:
+            ids = await run_on(self.shard, database.write_batch, [(kind, args) for kind, args, _ in batch], self.shard)
+        except Exception as e:
+            logger.error("Ошибка при групповой записи: %s", e)
+            ids = [None] * len(batch)
+        for (_, _, future), row_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(row_id)
+
+
+_writers = {}
+
+
+def _writer(shard: int) -> GroupCommitWriter:
+    writer = _writers.get(shard)
+    if writer is None:
+        writer = _writers[shard] = GroupCommitWriter(shard)
+    return writer
+
+
+# Flush started by add_user() when enough user changes are pending, at most one at a time
+_user_flushes = set()
+
+
+async def add_user(user_id: int, username: str):
+    """
+    Record a user in the user cache. The upsert is written behind in batches, a full
+    batch is flushed in the background, so the handler doesn't wait for the commit.
+    """
+    if registry.touch(user_id, username) and registry.needs_flush() and not _user_flushes:
+        task = asyncio.ensure_future(flush_users())
+        _user_flushes.add(task)
+        task.add_done_callback(_user_flushes.discard)
+
+
+async def get_user(user_id: int):
+    """Get a user from the user cache, loading it on the reader pool on a miss."""
+    hit, user = registry.peek(user_id)
+    if hit:
+        return user
+    return await read(registry.get, user_id)
+
+
+async def flush_users() -> int:
+    """Write pending user changes on the DB worker thread."""
+    return await run(registry.flush)
+
+
+async def add_question(from_user_id: int, to_user_id: int, question_text: str, media: tuple = None) -> int:
+    """Add a question through the group-commit writer of the recipient's shard."""
+    question_id = await _writer(database.shard_of_user(to_user_id)).submit(
+        "question", from_user_id, to_user_id, question_text, media
+    )
+    if question_id:
+        inbox.invalidate(to_user_id)
+    return question_id
+
+
+async def get_unanswered_questions(user_id: int) -> list:
+    """Async version of database.get_unanswered_questions."""
+    return await read(database.get_unanswered_questions, user_id)
+
+
+async def get_unanswered_questions_page(user_id: int, limit: int, cursor: tuple = None, direction: str = "next") -> tuple:
+    """Async version of database.get_unanswered_questions_page."""
+    return await read(database.get_unanswered_questions_page, user_id, limit, cursor, direction)
+
+
+async def get_inbox(user_id: int):
+    """
+    Get a user's newest unanswered questions from the inbox cache, loading up to
+    INBOX_CACHE_ROWS of them on the reader pool on a miss.
+    """
+    entry = inbox.get(user_id)
+    if entry is None:
+        token = inbox.load_started(user_id)
+        questions, has_older, _ = await get_unanswered_questions_page(user_id, INBOX_CACHE_ROWS)
+        entry = inbox.put(user_id, token, questions, not has_older)
+    return entry
+
+
+async def search_questions(user_id: int, terms: str, limit: int, offset: int = 0) -> tuple:
+    """Async version of database.search_questions."""
+    return await read(database.search_questions, user_id, terms, limit, offset)
+
+
+async def add_answer(question_id: int, answer_text: str, media: tuple = None) -> int:
+    """Add an answer through the group-commit writer of the question's shard."""
+    answer_id = await _writer(database.shard_of_question(question_id)).submit("answer", question_id, answer_text, media)
+    if answer_id:
+        inbox.invalidate_question(question_id)
+    return answer_id
+
+
+async def flush_writes():
+    """Commit question and answer inserts still waiting in the group-commit writer."""
+    await asyncio.gather(*(writer.flush() for writer in list(_writers.values())))
+
+
+async def get_user_counters(user_id: int) -> dict:
+    """Async version of database.get_user_counters."""
+    return await read(database.get_user_counters, user_id)
+
+
+async def get_question(question_id: int) -> dict:
+    """Async version of database.get_question."""
+    return await read(database.get_question, question_id)
+
+
+def queue_depth() -> int:
+    """Number of calls waiting for the DB worker and reader threads."""
+    executors = list(_executors.values()) + ([_readers] if _readers is not None else [])
+    return sum(executor._work_queue.qsize() for executor in executors)
+
+
+def shutdown():
+    """Wait for queued database calls to finish and stop the DB worker and reader threads."""
+    global _readers
+    if _readers is not None:
+        _readers.shutdown(wait=True)
+        _readers = None
+    if not _executors:
+        return
+    _get_executor(0).submit(registry.flush)
+    for executor in _executors.values():
+        executor.shutdown(wait=True)
+    _executors.clear()
+    _writers.clear()
+    logger.info("Потоки базы данных остановлены.")
@@ -0,0 +1,62 @@
+"""
+Compare question inserts per second with one commit per call against the group-commit writer.
+
+Usage: python -m benchmarks.group_commit [--rows 5000] [--concurrency 200] [--synchronous FULL]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import async_database
+import database
+
+
+async def insert_concurrently(add_question, rows: int, concurrency: int) -> float:
+    """Insert rows questions from concurrency concurrent senders and return inserts per second."""
+    async def sender(worker: int):
+        for i in range(worker, rows, concurrency):
+            await add_question(i, i % 1000, f"Вопрос {i}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(worker) for worker in range(concurrency)))
+    return rows / (time.perf_counter() - started)
+
+
+async def per_call_commit(from_user_id: int, to_user_id: int, question_text: str) -> int:
+    return await async_database.run(database.add_question, from_user_id, to_user_id, question_text)
+
+
+async def run_benchmark(rows: int, concurrency: int):
+    with tempfile.TemporaryDirectory() as directory:
+        database.set_database_file(os.path.join(directory, "per_call.db"))
+        database.init_db()
+        per_call = await insert_concurrently(per_call_commit, rows, concurrency)
+
+        database.set_database_file(os.path.join(directory, "group_commit.db"))
+        database.init_db()
+        grouped = await insert_concurrently(async_database.add_question, rows, concurrency)
+
+        async_database.shutdown()
+        database.close_connections()
+
+    print(f"Commit per call: {per_call:10.0f} inserts/s")
+    print(f"Group commit:    {grouped:10.0f} inserts/s ({grouped / per_call:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--synchronous", default="NORMAL", choices=["OFF", "NORMAL", "FULL"])
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    database.PRAGMAS = database.PRAGMAS + (f"PRAGMA synchronous={args.synchronous}",)
+    asyncio.run(run_benchmark(args.rows, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Stub Bot and synthetic updates for driving the real handlers without Telegram."""
+import asyncio
+import itertools
+import os
+import time
+
+from telegram.ext import Application, ExtBot
+
+# main.py refuses to import without a token, the stub bot never sends it anywhere
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCHMARK")
+# Don't start the metrics endpoint unless a port is given explicitly
+os.environ.setdefault("METRICS_PORT", "0")
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+
+
+class StubBot(ExtBot):
+    """
+    Bot that answers every Bot API call locally after `latency` seconds
+    and records (time, endpoint, chat_id) for each call in `calls`.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(token="123456:BENCHMARK")
+        with self._unfrozen():
+            self.latency = latency
+            self.calls = []
+            self._message_ids = itertools.count(1)
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = data.get("chat_id")
+        self.calls.append((time.perf_counter(), endpoint, chat_id))
+
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint.startswith(("send", "edit", "copy")):
+            return {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(user_id: int, text: str) -> dict:
+    """Update JSON for a private text message, with a bot_command entity for /commands."""
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str, message_id: int = 1) -> dict:
+    """Update JSON for an inline button press on a bot message in the user's private chat."""
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "chat_instance": str(user_id),
+            "from": _user(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "",
+            },
+        },
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of values, 0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def unthrottle_outbox():
+    """Replace the outbound scheduler with one that ignores Telegram's limits, the stub bot has none."""
+    import outbox
+
+    outbox.scheduler = outbox.OutboundScheduler(
+        global_rate=100000, global_burst=100000, chat_rate=100000, chat_burst=100000
+    )
+
+
+async def start_application(bot: StubBot, persistence: bool = True) -> Application:
+    """Build the real application from main.py around the stub bot and start it like run_polling would."""
+    import main as bot_main
+
+    application = bot_main.build_application(bot=bot, persistence=persistence)
+    await application.initialize()
+    await bot_main.post_init(application)
+    await application.start()
+    return application
+
+
+async def stop_application(application: Application):
+    """Stop the application and run the same shutdown hooks as run_polling."""
+    import main as bot_main
+
+    if application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    await bot_main.post_stop(application)
+    await application.shutdown()
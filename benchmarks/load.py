@@ -0,0 +1,194 @@
+"""
+Drive the real handlers from main.py with synthetic updates and report throughput,
+per-handler latency percentiles and time spent in the database.
+
+Workload: every flow picks a sender and a target from --users seeded users and runs one of
+  ask     /start <target> -> question text            (start, handle_question)
+  inbox   /questions -> answer button -> answer text   (view_questions, answer_callback, handle_answer)
+  command /answer <question_id> <text>                 (answer_question)
+Flows run concurrently, updates inside a flow run in order.
+
+Usage: python -m benchmarks.load [--users 10000] [--flows 2000] [--concurrency 100] [--latency 0.0]
+"""
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from telegram import Update
+
+from benchmarks.harness import (
+    StubBot, callback_update, message_update, percentile, start_application, stop_application, unthrottle_outbox
+)
+
+import async_database
+import database
+
+FLOW_WEIGHTS = {"ask": 6, "inbox": 3, "command": 1}
+SEED_QUESTIONS_PER_TARGET = 3
+
+
+def seed(users: int, targets: list) -> dict:
+    """Insert users and a few unanswered questions for every target. Returns {target: [question_id, ...]}."""
+    questions = {}
+    with database.transaction() as cursor:
+        cursor.executemany(
+            'INSERT INTO users (user_id, username) VALUES (?, ?)',
+            ((user_id, f"user{user_id}") for user_id in range(1, users + 1)),
+        )
+        for target in targets:
+            questions[target] = []
+            for i in range(SEED_QUESTIONS_PER_TARGET):
+                cursor.execute(
+                    'INSERT INTO questions (from_user_id, to_user_id, question_text) VALUES (?, ?, ?)',
+                    (random.randint(1, users), target, f"Заготовленный вопрос {i}"),
+                )
+                questions[target].append(cursor.lastrowid)
+    return questions
+
+
+def build_flows(users: int, flows: int) -> tuple:
+    """Pick flows and return (flows, seeded question ids). Each flow is a list of (label, update JSON)."""
+    kinds = random.choices(list(FLOW_WEIGHTS), weights=FLOW_WEIGHTS.values(), k=flows)
+    answerers = random.sample(range(1, users + 1), min(users, kinds.count("inbox") + kinds.count("command")))
+    questions = seed(users, answerers)
+
+    built = []
+    for number, kind in enumerate(kinds):
+        if kind == "ask":
+            sender, target = random.sample(range(1, users + 1), 2)
+            built.append([
+                ("start", message_update(sender, f"/start {target}")),
+                # Distinct texts, so that flood control doesn't drop them as duplicates
+                ("handle_question", message_update(sender, f"Анонимный вопрос для нагрузочного теста №{number}")),
+            ])
+            continue
+
+        target = answerers.pop()
+        question_id = questions[target][0]
+        if kind == "inbox":
+            built.append([
+                ("view_questions", message_update(target, "/questions")),
+                ("answer_callback", callback_update(target, f"answer_{question_id}")),
+                ("handle_answer", message_update(target, "Ответ из нагрузочного теста")),
+            ])
+        else:
+            built.append([
+                ("answer_question", message_update(target, f"/answer {question_id} Ответ командой")),
+            ])
+    return built
+
+
+class DatabaseTimer:
+    """Measures how long every call spends running on a DB worker or reader thread."""
+
+    def __init__(self):
+        self.durations = []
+        self._run_on = async_database.run_on
+        self._read = async_database.read
+
+    def install(self):
+        async def timed_run_on(shard, func, *args, **kwargs):
+            return await self._run_on(shard, self._timed(func), *args, **kwargs)
+
+        async def timed_read(func, *args, **kwargs):
+            return await self._read(self._timed(func), *args, **kwargs)
+
+        async_database.run_on = timed_run_on
+        async_database.read = timed_read
+
+    def uninstall(self):
+        async_database.run_on = self._run_on
+        async_database.read = self._read
+
+    def _timed(self, func):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.durations.append(time.perf_counter() - started)
+        return call
+
+
+async def run_flows(application, bot: StubBot, flows: list, concurrency: int) -> dict:
+    """Run flows with at most `concurrency` in flight. Returns {label: [latency, ...]}."""
+    latencies = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_flow(flow: list):
+        async with semaphore:
+            for label, data in flow:
+                update = Update.de_json(data, bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies[label].append(time.perf_counter() - started)
+
+    await asyncio.gather(*(run_flow(flow) for flow in flows))
+    return latencies
+
+
+def report(latencies: dict, db_durations: list, elapsed: float, bot: StubBot):
+    total = sum(len(values) for values in latencies.values())
+    print(f"Updates:     {total} in {elapsed:.2f} s ({total / elapsed:.0f} updates/s)")
+    print(f"Bot API:     {len(bot.calls)} calls")
+    print(f"DB time:     {sum(db_durations):.2f} s in {len(db_durations)} calls, "
+          f"p50 {percentile(db_durations, 0.5) * 1000:.2f} ms, p99 {percentile(db_durations, 0.99) * 1000:.2f} ms")
+    print()
+    print(f"{'handler':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    everything = [value for values in latencies.values() for value in values]
+    for label, values in sorted(latencies.items()) + [("all", everything)]:
+        print(f"{label:<18}{len(values):>8}"
+              f"{percentile(values, 0.5) * 1000:>10.2f}"
+              f"{percentile(values, 0.95) * 1000:>10.2f}"
+              f"{percentile(values, 0.99) * 1000:>10.2f}")
+
+
+async def run_benchmark(flows: list, concurrency: int, latency: float):
+    bot = StubBot(latency)
+    unthrottle_outbox()
+    application = await start_application(bot)
+
+    timer = DatabaseTimer()
+    timer.install()
+    started = time.perf_counter()
+    latencies = await run_flows(application, bot, flows, concurrency)
+    elapsed = time.perf_counter() - started
+    timer.uninstall()
+
+    await stop_application(application)
+    report(latencies, timer.durations, elapsed, bot)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000, help="Seeded users, e.g. 10000 to 1000000")
+    parser.add_argument("--flows", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0, help="Bot API latency of the stub bot, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        database.set_database_file(os.path.join(directory, "users.db"))
+        database.init_db()
+
+        print(f"Seeding {args.users} users...")
+        flows = build_flows(args.users, args.flows)
+        try:
+            asyncio.run(run_benchmark(flows, args.concurrency, args.latency))
+        finally:
+            async_database.shutdown()
+            database.close_connections()
+
+
+if __name__ == "__main__":
+    main()
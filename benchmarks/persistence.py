@@ -0,0 +1,151 @@
+"""
+Check that conversation state and user_data survive a restart, and that persistence adds
+no per-update latency.
+
+Restart: one user opens another's link, which starts the question state of the conversation,
+and the other presses the answer button under a question, which keeps the question id in
+user_data. The application is stopped and a new one is built on the same database, which
+must restore both, so that the next messages are saved as the question and the answer.
+
+Latency: runs the same flows as benchmarks.load with SQLitePersistence and without any
+persistence, and reports per-update latency percentiles of both. SQLitePersistence writes
+in the background every few seconds and on shutdown, so the two should match.
+
+Usage: python -m benchmarks.persistence [--users 2000] [--flows 500] [--concurrency 1]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+
+from benchmarks.harness import (
+    StubBot, callback_update, message_update, percentile, start_application, stop_application, unthrottle_outbox
+)
+from benchmarks.load import build_flows, run_flows
+
+import async_database
+import database
+
+ANSWERER = 1
+ASKER = 2
+
+
+def conversation_state(application, user_id: int):
+    """State of a user's private-chat conversation in the application's ConversationHandler, or None."""
+    handler = next(
+        handler for handlers in application.handlers.values() for handler in handlers
+        if isinstance(handler, ConversationHandler)
+    )
+    return handler._conversations.get((user_id, user_id))
+
+
+async def check_restart() -> list:
+    """
+    Start asking a question and press an answer button, restart, then send the question and
+    the answer. Returns a list of failed checks, empty if all passed.
+    """
+    import main as bot_main
+
+    failures = []
+    bot = StubBot()
+    unthrottle_outbox()
+    application = await start_application(bot)
+    question_id = await async_database.add_question(ASKER, ANSWERER, "Вопрос до перезапуска")
+    await application.process_update(Update.de_json(message_update(ASKER, f"/start {ANSWERER}"), bot))
+    await application.process_update(Update.de_json(callback_update(ANSWERER, f"answer_{question_id}"), bot))
+    if conversation_state(application, ASKER) != bot_main.ASKING_QUESTION:
+        failures.append("/start with a link did not start the question state")
+    await stop_application(application)
+
+    bot = StubBot()
+    application = await start_application(bot)
+    if conversation_state(application, ASKER) != bot_main.ASKING_QUESTION:
+        failures.append("the question state was not restored")
+    if application.user_data.get(ASKER, {}).get("target_user_id") != ANSWERER:
+        failures.append("target_user_id in user_data was not restored")
+    if application.user_data.get(ANSWERER, {}).get("question_id") != question_id:
+        failures.append("question_id in user_data was not restored")
+
+    await application.process_update(Update.de_json(message_update(ASKER, "Вопрос после перезапуска"), bot))
+    await application.process_update(Update.de_json(message_update(ANSWERER, "Ответ после перезапуска"), bot))
+    await async_database.flush_writes()
+    questions = await async_database.get_unanswered_questions(ANSWERER)
+    if [question[2] for question in questions] != ["Вопрос после перезапуска"]:
+        failures.append("the question after the restart was not saved")
+    if conversation_state(application, ASKER) is not None:
+        failures.append("the conversation did not end after the question")
+    question = await async_database.get_question(question_id)
+    if not question or question[8] != "Ответ после перезапуска":
+        failures.append("the answer after the restart was not saved")
+    await stop_application(application)
+    return failures
+
+
+async def measure(flows: list, concurrency: int, persistence: bool) -> list:
+    """Per-update latencies of the flows, with or without persistence."""
+    bot = StubBot()
+    unthrottle_outbox()
+    application = await start_application(bot, persistence=persistence)
+    latencies = await run_flows(application, bot, flows, concurrency)
+    await stop_application(application)
+    return [value for values in latencies.values() for value in values]
+
+
+def with_database(path: str, func, *args):
+    """Run a coroutine function against a fresh database at path."""
+    database.set_database_file(path)
+    database.init_db()
+    try:
+        return asyncio.run(func(*args))
+    finally:
+        async_database.shutdown()
+        database.close_connections()
+
+
+def measure_on_fresh_database(path: str, args, persistence: bool) -> list:
+    """Seed a database at path with the same flows every time and measure them."""
+    database.set_database_file(path)
+    database.init_db()
+    random.seed(args.seed)
+    flows = build_flows(args.users, args.flows)
+    database.close_connections()
+    return with_database(path, measure, flows, args.concurrency, persistence)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--flows", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1, help="flows in flight, 1 measures updates one at a time")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        failures = with_database(os.path.join(directory, "restart.db"), check_restart)
+
+        # The first run in a process is slower, so one is made before measuring and thrown away
+        measure_on_fresh_database(os.path.join(directory, "warmup.db"), args, False)
+        results = {
+            persistence: measure_on_fresh_database(os.path.join(directory, f"persistence_{persistence}.db"), args, persistence)
+            for persistence in (False, True)
+        }
+
+    print("Restart:      " + ("conversation state and user_data restored, question and answer saved" if not failures else "; ".join(failures)))
+    print(f"{'persistence':<14}{'updates':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for persistence, latencies in results.items():
+        print(f"{'SQLite' if persistence else 'none':<14}{len(latencies):>8}"
+              f"{percentile(latencies, 0.5) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.95) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.2f}")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Measure /search query latency on a large questions table.
+
+Questions are random phrases from a small vocabulary, spread over --users inboxes,
+so common words match in many inboxes and the owner filter has real work to do.
+
+Usage: python -m benchmarks.search [--rows 1000000] [--users 10000] [--queries 1000]
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.harness import percentile
+
+import database
+
+WORDS = (
+    "как почему где когда кто что любимый фильм книга музыка город работа учеба друзья "
+    "отпуск мечта кофе чай спорт игра кот собака море горы лето зима утро вечер план совет"
+).split()
+BATCH = 10000
+
+
+def seed(rows: int, users: int):
+    """Insert rows questions and answer every third one. The triggers fill the search index."""
+    for start in range(0, rows, BATCH):
+        with database.transaction() as cursor:
+            for _ in range(start, min(rows, start + BATCH)):
+                text = " ".join(random.choices(WORDS, k=random.randint(4, 12))) + "?"
+                question_id = database._insert_question(cursor, random.randint(1, users), random.randint(1, users), text)
+                if question_id % 3 == 0:
+                    database._insert_answer(cursor, question_id, " ".join(random.choices(WORDS, k=6)))
+
+
+def run_queries(users: int, queries: int, page_size: int) -> dict:
+    """Run one- and two-word searches in random inboxes. Returns {label: [latency, ...]}."""
+    latencies = {"1 word": [], "2 words": [], "page 2": []}
+    for _ in range(queries):
+        user_id = random.randint(1, users)
+        for label, terms, offset in (
+            ("1 word", random.choice(WORDS), 0),
+            ("2 words", " ".join(random.sample(WORDS, 2)), 0),
+            ("page 2", random.choice(WORDS), page_size),
+        ):
+            started = time.perf_counter()
+            database.search_questions(user_id, terms, page_size, offset)
+            latencies[label].append(time.perf_counter() - started)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        database.set_database_file(os.path.join(directory, "users.db"))
+        database.init_db()
+
+        started = time.perf_counter()
+        seed(args.rows, args.users)
+        print(f"Seeded {args.rows} questions in {time.perf_counter() - started:.1f} s, "
+              f"about {args.rows // args.users} per inbox")
+
+        latencies = run_queries(args.users, args.queries, args.page_size)
+        database.close_connections()
+
+    print(f"{'query':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for label, values in latencies.items():
+        print(f"{label:<10}{len(values):>8}"
+              f"{percentile(values, 0.5) * 1000:>10.2f}"
+              f"{percentile(values, 0.95) * 1000:>10.2f}"
+              f"{percentile(values, 0.99) * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare question and answer writes per second through async_database with 1, 2, 4 and 8 shards.
+
+Every shard has its own DB worker thread and group-commit writer, so writes to different
+shards commit in parallel. With --memory the shards are in-memory databases, which leaves
+out the file system and shows the CPU side alone.
+
+Usage: python -m benchmarks.shards [--rows 20000] [--concurrency 400] [--shards 1,2,4,8] [--synchronous FULL] [--memory]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import async_database
+import database
+
+
+async def write_concurrently(rows: int, concurrency: int, recipients: int) -> float:
+    """Add rows questions and answer every other one from concurrency concurrent senders. Returns writes per second."""
+    async def sender(worker: int):
+        for i in range(worker, rows, concurrency):
+            question_id = await async_database.add_question(i, i % recipients, f"Вопрос {i}")
+            if i % 2:
+                await async_database.add_answer(question_id, f"Ответ {i}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(worker) for worker in range(concurrency)))
+    return (rows + rows // 2) / (time.perf_counter() - started)
+
+
+def run_benchmark(directory: str, shards: int, args) -> float:
+    database.set_database_file(os.path.join(directory, f"users{shards}.db"), shards, memory=args.memory)
+    database.init_db()
+    try:
+        return asyncio.run(write_concurrently(args.rows, args.concurrency, args.recipients))
+    finally:
+        async_database.shutdown()
+        database.close_connections()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=400)
+    parser.add_argument("--recipients", type=int, default=5000)
+    parser.add_argument("--shards", default="1,2,4,8", help="comma separated shard counts")
+    parser.add_argument("--synchronous", default="NORMAL", choices=["OFF", "NORMAL", "FULL"])
+    parser.add_argument("--memory", action="store_true", help="use in-memory shards")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    database.PRAGMAS = database.PRAGMAS + (f"PRAGMA synchronous={args.synchronous}",)
+    baseline = None
+    with tempfile.TemporaryDirectory() as directory:
+        for shards in (int(count) for count in args.shards.split(",")):
+            writes = run_benchmark(directory, shards, args)
+            baseline = baseline or writes
+            print(f"{shards} shard(s): {writes:10.0f} writes/s ({writes / baseline:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
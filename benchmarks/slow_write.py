@@ -0,0 +1,122 @@
+"""
+Show that handler latency stays flat while a slow database write is in progress.
+
+Fires updates from many users at a steady rate, three times: with the database idle, while
+a write transaction held open for --duration seconds (standing in for a slow commit or
+fsync) runs on the DB worker through async_database, and while the same write runs directly
+on the event loop, as handlers did before async_database existed. Half of the updates are
+/help and /getlink, which don't wait for the database, the other half read it: /questions,
+/stats and /start with a link of a user who isn't cached. Reports handler latency
+percentiles of both kinds for each phase.
+
+Usage: python -m benchmarks.slow_write [--duration 1.0] [--users 200] [--interval 0.005]
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import tempfile
+import time
+
+from telegram import Update
+
+from benchmarks.harness import StubBot, message_update, percentile, start_application, stop_application, unthrottle_outbox
+
+import async_database
+import database
+
+
+# Commands fired in turn, and whether they read the database
+COMMANDS = (("/help", False), ("/questions", True), ("/getlink", False), ("/stats", True),
+            ("/help", False), ("/start {target}", True))
+# Ids of link owners for /start, past every user sending updates, so they are never cached
+TARGETS_START = 10 ** 9
+
+
+def slow_write(seconds: float):
+    """A write transaction that takes `seconds` to commit."""
+    with database.transaction() as cursor:
+        cursor.execute("INSERT INTO users (user_id, username) VALUES (-1, 'slow') ON CONFLICT DO NOTHING")
+        time.sleep(seconds)
+
+
+async def fire_updates(application, bot: StubBot, users: range, interval: float, targets) -> dict:
+    """
+    Process one update per user, due every `interval` seconds. Returns their latencies by
+    whether the command reads the database, counted from when each update was due, so time
+    the event loop was blocked is included.
+    """
+    latencies = {False: [], True: []}
+
+    async def process(data: dict, due: float, reads: bool):
+        await application.process_update(Update.de_json(data, bot))
+        latencies[reads].append(time.perf_counter() - due)
+
+    tasks = []
+    started = time.perf_counter()
+    for number, (user_id, (command, reads)) in enumerate(zip(users, itertools.cycle(COMMANDS))):
+        due = started + number * interval
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        text = command.format(target=next(targets))
+        tasks.append(asyncio.create_task(process(message_update(user_id, text), due, reads)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+async def run_benchmark(users: int, interval: float, duration: float) -> dict:
+    bot = StubBot()
+    unthrottle_outbox()
+    application = await start_application(bot)
+    # Every phase has its own users, so that /start begins a new conversation each time
+    phases = (range(start, start + users) for start in itertools.count(1, users))
+    targets = itertools.count(TARGETS_START)
+
+    # The first updates are slower, so one round is made before measuring and thrown away
+    await fire_updates(application, bot, next(phases), interval, targets)
+    results = {"idle": await fire_updates(application, bot, next(phases), interval, targets)}
+
+    write = asyncio.create_task(async_database.run(slow_write, duration))
+    await asyncio.sleep(0.01)
+    results["slow write on DB worker"] = await fire_updates(application, bot, next(phases), interval, targets)
+    await write
+
+    async def write_on_loop():
+        await asyncio.sleep(0.01)
+        slow_write(duration)
+
+    write = asyncio.create_task(write_on_loop())
+    results["slow write on event loop"] = await fire_updates(application, bot, next(phases), interval, targets)
+    await write
+
+    await stop_application(application)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=1.0, help="how long the slow write takes, seconds")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between updates")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        database.set_database_file(os.path.join(directory, "users.db"))
+        database.init_db()
+        try:
+            results = asyncio.run(run_benchmark(args.users, args.interval, args.duration))
+        finally:
+            async_database.shutdown()
+            database.close_connections()
+
+    print(f"Slow write: {args.duration:.1f} s, {args.users} updates every {args.interval * 1000:.0f} ms")
+    print(f"{'phase':<28}{'updates':<10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for phase, by_kind in results.items():
+        for reads, latencies in by_kind.items():
+            print(f"{phase:<28}{'DB reads' if reads else 'no DB':<10}{percentile(latencies, 0.5) * 1000:>10.2f}"
+                  f"{percentile(latencies, 0.99) * 1000:>10.2f}{max(latencies) * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Measure update throughput through the application's update queue, as with polling or a webhook.
+
+Builds the same flows as benchmarks.load, interleaves them and puts every update into the
+update queue at once, so the queue fills up and backpressure kicks in. Reports throughput,
+latency from put() to the end of processing, time the producer spent blocked on a full
+queue, and checks that every user's updates were processed in the order they were put.
+Run it once with the default processor and once with --max-concurrent 1 to compare.
+
+Usage: python -m benchmarks.updates [--users 10000] [--flows 2000] [--latency 0.02] [--max-concurrent 64]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from benchmarks.harness import StubBot, percentile, start_application, stop_application, unthrottle_outbox
+from benchmarks.load import build_flows
+
+import async_database
+import database
+
+
+def interleave(flows: list) -> list:
+    """First step of every flow, then the second step of every flow and so on."""
+    steps = []
+    for step in range(max(len(flow) for flow in flows)):
+        steps += [flow[step] for flow in flows if step < len(flow)]
+    return steps
+
+
+async def run_benchmark(updates: list, latency: float) -> dict:
+    bot = StubBot(latency)
+    unthrottle_outbox()
+    application = await start_application(bot)
+
+    put_at = {}
+    done_at = {}
+    started_order = defaultdict(list)
+
+    async def record_start(update: Update, context):
+        started_order[update.effective_user.id].append(update.update_id)
+
+    async def record_end(update: Update, context):
+        done_at[update.update_id] = time.perf_counter()
+
+    application.add_handler(TypeHandler(Update, record_start), group=-1)
+    application.add_handler(TypeHandler(Update, record_end), group=99)
+
+    blocked = 0.0
+    started = time.perf_counter()
+    put_order = defaultdict(list)
+    for _, data in updates:
+        update = Update.de_json(data, bot)
+        put_order[update.effective_user.id].append(update.update_id)
+        before = time.perf_counter()
+        put_at[update.update_id] = before
+        await application.update_queue.put(update)
+        blocked += time.perf_counter() - before
+    await application.update_queue.join()
+    elapsed = time.perf_counter() - started
+
+    await stop_application(application)
+    return {
+        "elapsed": elapsed,
+        "blocked": blocked,
+        "latencies": [done_at[update_id] - put_at[update_id] for update_id in done_at],
+        "out_of_order": sum(started_order[user] != put_order[user] for user in put_order),
+        "users": len(put_order),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--flows", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02, help="Bot API latency of the stub bot, seconds")
+    parser.add_argument("--max-concurrent", type=int, default=None,
+                        help="Updates processed at once, 1 processes them one by one (default: as in main.py)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    import main as bot_main
+    if args.max_concurrent is not None:
+        bot_main.MAX_CONCURRENT_UPDATES = args.max_concurrent
+
+    random.seed(args.seed)
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        database.set_database_file(os.path.join(directory, "users.db"))
+        database.init_db()
+        updates = interleave(build_flows(args.users, args.flows))
+        try:
+            result = asyncio.run(run_benchmark(updates, args.latency))
+        finally:
+            async_database.shutdown()
+            database.close_connections()
+
+    latencies = result["latencies"]
+    print(f"Max concurrent: {bot_main.MAX_CONCURRENT_UPDATES}, pending limit: {bot_main.MAX_PENDING_UPDATES}")
+    print(f"Updates:        {len(updates)} in {result['elapsed']:.2f} s "
+          f"({len(updates) / result['elapsed']:.0f} updates/s)")
+    print(f"Producer:       blocked {result['blocked']:.2f} s on a full queue")
+    print(f"Latency ms:     p50 {percentile(latencies, 0.5) * 1000:.1f}, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.1f}, p99 {percentile(latencies, 0.99) * 1000:.1f}")
+    print(f"Ordering:       {result['out_of_order']} of {result['users']} users saw updates out of order")
+
+
+if __name__ == "__main__":
+    main()
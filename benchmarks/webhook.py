@@ -0,0 +1,126 @@
+"""
+Serve the real application in webhook mode on localhost, POST Update JSON to it
+and measure the time from the POST to the bot's first reply in the same chat.
+
+Usage: python -m benchmarks.webhook [--users 500] [--updates recorded.jsonl] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.harness import (
+    StubBot, message_update, percentile, start_application, stop_application, unthrottle_outbox
+)
+
+import async_database
+import database
+import main as bot_main
+import outbox
+
+SECRET_TOKEN = "benchmark-secret"
+
+
+def synthetic_updates(users: int) -> list:
+    """Deep-link /start followed by a question for every sender."""
+    updates = []
+    for user_id in range(1, users + 1):
+        target = users + 1 + user_id % 10
+        updates.append(message_update(user_id, f"/start {target}"))
+        updates.append(message_update(user_id, f"Вопрос от {user_id}"))
+    return updates
+
+
+def chat_of(update: dict) -> int:
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    return update["callback_query"]["from"]["id"]
+
+
+async def wait_until_idle(bot: StubBot, quiet: float = 0.2):
+    """Wait until updates are processed and no Bot API calls were made for `quiet` seconds."""
+    seen = -1
+    while seen != len(bot.calls) or outbox.scheduler.pending():
+        seen = len(bot.calls)
+        await asyncio.sleep(quiet)
+
+
+async def post_updates(updates: list, port: int, bot: StubBot) -> list:
+    """POST updates in order, one request per update, and return the end-to-end latency of each."""
+    url = f"http://127.0.0.1:{port}/{bot_main.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN}
+    posted = []
+    async with httpx.AsyncClient() as client:
+        for update in updates:
+            posted.append((time.perf_counter(), chat_of(update)))
+            response = await client.post(url, json=update, headers=headers)
+            response.raise_for_status()
+
+    await wait_until_idle(bot)
+
+    sends = [(sent_at, chat_id) for sent_at, endpoint, chat_id in bot.calls if endpoint == "sendMessage"]
+    latencies = []
+    for posted_at, chat_id in posted:
+        reply = next((sent_at for sent_at, chat in sends if chat == chat_id and sent_at >= posted_at), None)
+        if reply is not None:
+            latencies.append(reply - posted_at)
+            sends.remove((reply, chat_id))
+    return latencies
+
+
+async def run_benchmark(updates: list, port: int, latency: float):
+    bot = StubBot(latency)
+    unthrottle_outbox()
+    application = await start_application(bot)
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=port,
+        url_path=bot_main.WEBHOOK_PATH,
+        webhook_url=f"http://127.0.0.1:{port}/{bot_main.WEBHOOK_PATH}",
+        secret_token=SECRET_TOKEN,
+    )
+
+    started = time.perf_counter()
+    latencies = await post_updates(updates, port, bot)
+    elapsed = time.perf_counter() - started
+
+    await stop_application(application)
+
+    print(f"Updates:    {len(updates)} in {elapsed:.2f} s ({len(updates) / elapsed:.0f} updates/s)")
+    print(f"Replies:    {len(latencies)}")
+    print(f"Latency ms: p50 {percentile(latencies, 0.5) * 1000:.1f}, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.1f}, p99 {percentile(latencies, 0.99) * 1000:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--updates", help="JSONL file with recorded Update objects, one per line")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Bot API latency of the stub bot, seconds")
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = synthetic_updates(args.users)
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as directory:
+        database.set_database_file(os.path.join(directory, "users.db"))
+        database.init_db()
+        try:
+            asyncio.run(run_benchmark(updates, args.port, args.latency))
+        finally:
+            async_database.shutdown()
+            database.close_connections()
+
+
+if __name__ == "__main__":
+    main()
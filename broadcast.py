@@ -0,0 +1,107 @@
+import asyncio
+import logging
+
+from telegram.error import BadRequest, Forbidden
+
+import async_database
+import database
+import outbox
+
+logger = logging.getLogger(__name__)
+
+# Recipients read and checkpointed together. A restart resends at most one batch.
+BROADCAST_BATCH_SIZE = 500
+# Broadcast messages queued in the outbox at once. The outbox enforces the global rate
+# limit, this only keeps a broadcast from filling its queue ahead of everything else.
+BROADCAST_CONCURRENCY = 30
+
+# Results of a single send
+SENT = "sent"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+# Errors meaning the chat is gone for good rather than a failed attempt
+GONE_CHAT_ERRORS = ("chat not found", "user is deactivated")
+
+_running = None
+
+
+async def _send(semaphore: asyncio.Semaphore, user_id: int, text: str) -> str:
+    async with semaphore:
+        try:
+            await outbox.send_message(user_id, text, outbox.BROADCAST, log_errors=False, parse_mode='HTML')
+            return SENT
+        except Forbidden:
+            return BLOCKED
+        except BadRequest as e:
+            if any(error in str(e).lower() for error in GONE_CHAT_ERRORS):
+                return BLOCKED
+            logger.warning("Не удалось отправить рассылку пользователю %s: %s", user_id, e)
+            return FAILED
+        except Exception as e:
+            logger.warning("Не удалось отправить рассылку пользователю %s: %s", user_id, e)
+            return FAILED
+
+
+async def _run(broadcast: dict) -> dict:
+    """
+    Send a broadcast batch by batch from its saved cursor. Returns its final state,
+    or None if the database failed, leaving it to be resumed later.
+    """
+    broadcast_id = broadcast["broadcast_id"]
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    while True:
+        recipients = await async_database.read(
+            database.get_broadcast_recipients, broadcast["position"], BROADCAST_BATCH_SIZE
+        )
+        if recipients is None:
+            return None
+        if not recipients:
+            await async_database.run(database.finish_broadcast, broadcast_id, database.BROADCAST_DONE)
+            broadcast["status"] = database.BROADCAST_DONE
+            return broadcast
+
+        results = await asyncio.gather(*(_send(semaphore, user_id, broadcast["text"]) for user_id in recipients))
+        blocked = [user_id for user_id, result in zip(recipients, results) if result == BLOCKED]
+        sent = results.count(SENT)
+        failed = results.count(FAILED)
+        saved = await async_database.run(
+            database.save_broadcast_progress, broadcast_id, recipients[-1], sent, failed, blocked
+        )
+        # Re-read the broadcast, so a cancellation is seen within one batch
+        broadcast = saved and await async_database.read(database.get_broadcast, broadcast_id)
+        if not broadcast:
+            return None
+        if broadcast["status"] != database.BROADCAST_RUNNING:
+            return broadcast
+        logger.info("Рассылка %s: отправлено %s, заблокировали бота %s, ошибок %s",
+                    broadcast_id, broadcast["sent"], broadcast["blocked"], broadcast["failed"])
+
+
+async def run() -> dict:
+    """
+    Send the running broadcast, if there is one, to every user who hasn't blocked the bot.
+    Progress is saved after every batch, so after a restart this continues where it stopped.
+    Returns the broadcast's final state, or None if there was nothing to send, it is
+    already being sent or it was interrupted.
+    """
+    global _running
+    if _running is not None:
+        return None
+    broadcast = await async_database.read(database.get_broadcast)
+    if broadcast is None:
+        return None
+
+    _running = broadcast["broadcast_id"]
+    try:
+        logger.info("Рассылка %s начата с позиции %s", _running, broadcast["position"])
+        broadcast = await _run(broadcast)
+        if broadcast is None:
+            logger.error("Рассылка %s прервана из-за ошибки базы данных, продолжится после перезапуска", _running)
+            return None
+        logger.info("Рассылка %s завершена (%s): отправлено %s, заблокировали бота %s, ошибок %s",
+                    broadcast["broadcast_id"], broadcast["status"],
+                    broadcast["sent"], broadcast["blocked"], broadcast["failed"])
+        return broadcast
+    finally:
+        _running = None
@@ -1,202 +1,980 @@
+import re
 import sqlite3
 import logging
+import os
+import threading
+import unicodedata
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import metrics
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 DATABASE_FILE = "users.db"
 
-def init_db():
-    """Initialize the database."""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create questions table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS questions (
-                question_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                from_user_id INTEGER,
-                to_user_id INTEGER,
-                question_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_answered BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (from_user_id) REFERENCES users (user_id),
-                FOREIGN KEY (to_user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        # Create answers table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS answers (
-                answer_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                question_id INTEGER,
-                answer_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (question_id) REFERENCES questions (question_id)
+# Questions are spread over shards by recipient in this many buckets, bucket b lives on
+# shard b % shard count. It caps the number of shards and must never change.
+NUM_BUCKETS = 256
+
+# Connection settings
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+)
+
+
+class ConnectionManager:
+    """
+    Keeps one long-lived SQLite connection per thread.
+    Connections are opened lazily, configured once with PRAGMAS and reused
+    by every query, so the file open and schema read happen only once.
+    """
+
+    def __init__(self, database_file: str):
+        self.database_file = database_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def connection(self) -> sqlite3.Connection:
+        """Return the connection bound to the current thread, opening it if needed."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.uri(),
+                timeout=BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                check_same_thread=False,
+                uri=True,
             )
-        ''')
-        
-        conn.commit()
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def uri(self) -> str:
+        """Name the database is opened and attached by."""
+        return self.database_file
+
+    @contextmanager
+    def transaction(self, immediate: bool = True):
+        """
+        Run a block inside a single transaction and yield a cursor.
+        Commits on success, rolls back on error. Nested calls join the outer transaction.
+        """
+        conn = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn.cursor()
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self._local.depth = 1
+        try:
+            yield conn.cursor()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    def close_all(self):
+        """Close every connection opened by this manager."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.error("Ошибка при закрытии соединения с базой данных: %s", e)
+        self._local = threading.local()
+        logger.info("Соединения с базой данных закрыты.")
+
+
+class MemoryConnectionManager(ConnectionManager):
+    """
+    ConnectionManager over an in-memory database, for tests and benchmarks.
+    It uses SQLite's memdb VFS, so every thread sees the same database with normal locking.
+    The database is gone once all its connections are closed.
+    """
+
+    def uri(self) -> str:
+        # A name starting with "/" is shared by all connections of the process
+        return f"file:/{quote(self.database_file.lstrip('/'))}?vfs=memdb"
+
+
+# Shard 0 is the main database, it also holds users, conversation state and broadcasts
+_shards = [ConnectionManager(DATABASE_FILE)]
+
+
+def shard_files(database_file: str, shard_count: int) -> list:
+    """Database files of every shard: the main file, then e.g. users.shard1.db, users.shard2.db."""
+    root, extension = os.path.splitext(database_file)
+    return [database_file] + [f"{root}.shard{shard}{extension}" for shard in range(1, shard_count)]
+
+
+def shard_count() -> int:
+    return len(_shards)
+
+
+def bucket_of_user(user_id: int) -> int:
+    return user_id % NUM_BUCKETS
+
+
+def shard_of_user(user_id: int) -> int:
+    """Shard holding the questions a user received."""
+    return bucket_of_user(user_id) % len(_shards)
+
+
+def shard_of_question(question_id: int) -> int:
+    """Shard holding a question. Question ids carry their bucket, so no lookup is needed."""
+    return question_id % NUM_BUCKETS % len(_shards)
+
+
+def get_connection(shard: int = 0) -> sqlite3.Connection:
+    """Get the pooled connection to a shard for the current thread."""
+    return _shards[shard].connection()
+
+
+def transaction(immediate: bool = True, shard: int = 0):
+    """Context manager running a block in one transaction on a shard's pooled connection."""
+    return _shards[shard].transaction(immediate)
+
+
+def close_connections():
+    """Close all pooled connections. Called on bot shutdown."""
+    for manager in _shards:
+        manager.close_all()
+
+
+def set_database_file(database_file: str, shards: int = 1, memory: bool = False):
+    """
+    Point the storage at another database file split into the given number of shards,
+    e.g. from SHARD_COUNT or for benchmarks. With memory, the shards are in-memory databases.
+    """
+    global DATABASE_FILE, _shards
+    if not 1 <= shards <= NUM_BUCKETS:
+        raise ValueError(f"Число шардов должно быть от 1 до {NUM_BUCKETS}")
+    close_connections()
+    DATABASE_FILE = database_file
+    manager = MemoryConnectionManager if memory else ConnectionManager
+    _shards = [manager(name) for name in shard_files(database_file, shards)]
+
+
+@metrics.timed("db")
+def init_db():
+    """Create or upgrade the schema of every shard with the migrations in migrations.py."""
+    # Imported here because migrations builds on this module
+    import migrations
+
+    try:
+        for shard in range(len(_shards)):
+            enable_incremental_vacuum(shard=shard)
+            migrations.migrate(shard=shard)
+            if shard == 0:
+                _check_shard_layout()
         logger.info("База данных успешно инициализирована.")
-        
-        conn.close()
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при инициализации базы данных: {e}")
-
-def add_question(from_user_id: int, to_user_id: int, question_text: str) -> int:
-    """Add a new question to the database."""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO questions (from_user_id, to_user_id, question_text)
-            VALUES (?, ?, ?)
-        ''', (from_user_id, to_user_id, question_text))
-        
-        question_id = cursor.lastrowid
-        conn.commit()
-        logger.info(f"Добавлен новый вопрос от {from_user_id} к {to_user_id} с ID {question_id}")
-        
-        conn.close()
+    except sqlite3.Error as e:
+        logger.error("Ошибка при инициализации базы данных: %s", e)
+        raise
+
+def _check_shard_layout():
+    """
+    Make sure the data was laid out for the configured number of shards. A new database,
+    or one that was never sharded, records it. Raises ValueError on a mismatch.
+    """
+    with transaction() as cursor:
+        row = cursor.execute("SELECT shard_count, rebalance_to FROM shard_layout").fetchone()
+        if row is None:
+            if len(_shards) == 1 or not cursor.execute("SELECT 1 FROM questions LIMIT 1").fetchone():
+                cursor.execute("INSERT INTO shard_layout (shard_count) VALUES (?)", (len(_shards),))
+                return
+            row = (1, None)
+    if row[1] is not None:
+        raise ValueError(
+            f"Перераспределение шардов с {row[0]} на {row[1]} не завершено. "
+            f"Завершить: python -m sharding --database {DATABASE_FILE} --from {row[0]} --to {row[1]}"
+        )
+    if row[0] != len(_shards):
+        raise ValueError(
+            f"База данных разбита на {row[0]} шардов, а настроено {len(_shards)}. "
+            f"Перераспределить: python -m sharding --database {DATABASE_FILE} --from {row[0]} --to {len(_shards)}"
+        )
+
+def enable_incremental_vacuum(schema: str = "main", convert_existing: bool = False, shard: int = 0):
+    """
+    Switch a database to incremental auto-vacuum, so that pages freed by archiving
+    can be returned to the file system in small steps with incremental_vacuum().
+    The switch takes a VACUUM that rewrites the whole file, so databases that already
+    have tables are only converted with convert_existing, e.g. by python -m migrations --vacuum.
+    """
+    conn = get_connection(shard)
+    if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] == 2:
+        return
+    if conn.execute(f"SELECT count(*) FROM {schema}.sqlite_master").fetchone()[0] and not convert_existing:
+        logger.warning("Для %s не включен incremental auto_vacuum, включить: python -m migrations --vacuum", schema)
+        return
+    conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+    conn.execute(f"VACUUM {schema}")
+
+def _count(cursor: sqlite3.Cursor, user_id: int, **deltas):
+    """Add deltas to a user's counters, e.g. _count(cursor, user_id, received=1)."""
+    columns = ", ".join(deltas)
+    updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in deltas)
+    cursor.execute(f'''
+        INSERT INTO user_counters (user_id, {columns}) VALUES (?{", ?" * len(deltas)})
+        ON CONFLICT (user_id) DO UPDATE SET {updates}
+    ''', (user_id, *deltas.values()))
+
+def _next_id(cursor: sqlite3.Cursor, bucket: int) -> int:
+    """
+    Allocate a question or answer id in a bucket: id % NUM_BUCKETS is the bucket, so the
+    shard of a question is known from its id alone. A bucket's sequence starts past every
+    id the shard has handed out, so ids from before sharding are never reused.
+    """
+    seq = cursor.execute('''
+        INSERT INTO bucket_sequences (bucket, last_seq)
+        SELECT ?, coalesce(max(seq), 0) / ? + 1 FROM sqlite_sequence WHERE name IN ('questions', 'answers')
+        ON CONFLICT (bucket) DO UPDATE SET last_seq = last_seq + 1
+        RETURNING last_seq
+    ''', (bucket, NUM_BUCKETS)).fetchone()[0]
+    return seq * NUM_BUCKETS + bucket
+
+def _insert_media(cursor: sqlite3.Cursor, media: tuple) -> str:
+    """
+    Store a (media_type, file_id, file_unique_id) reference once per file and return its
+    file_unique_id, or None without media. The newest file_id is kept.
+    """
+    if media is None:
+        return None
+    media_type, file_id, file_unique_id = media
+    cursor.execute('''
+        INSERT INTO media (file_unique_id, media_type, file_id) VALUES (?, ?, ?)
+        ON CONFLICT (file_unique_id) DO UPDATE SET file_id = excluded.file_id
+    ''', (file_unique_id, media_type, file_id))
+    return file_unique_id
+
+def _insert_question(cursor: sqlite3.Cursor, from_user_id: int, to_user_id: int, question_text: str,
+                     media: tuple = None) -> int:
+    question_id = _next_id(cursor, bucket_of_user(to_user_id))
+    cursor.execute('''
+        INSERT INTO questions (question_id, from_user_id, to_user_id, question_text, file_unique_id)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (question_id, from_user_id, to_user_id, question_text, _insert_media(cursor, media)))
+
+    _count(cursor, to_user_id, received=1, unanswered=1)
+    _count(cursor, from_user_id, asked=1)
+    return question_id
+
+def _insert_answer(cursor: sqlite3.Cursor, question_id: int, answer_text: str, media: tuple = None) -> int:
+    # Add answer, numbered in the question's bucket
+    answer_id = _next_id(cursor, question_id % NUM_BUCKETS)
+    cursor.execute('''
+        INSERT INTO answers (answer_id, question_id, answer_text, file_unique_id)
+        VALUES (?, ?, ?, ?)
+    ''', (answer_id, question_id, answer_text, _insert_media(cursor, media)))
+
+    # Mark question as answered, counting it only the first time
+    cursor.execute('''
+        UPDATE questions
+        SET is_answered = TRUE
+        WHERE question_id = ? AND NOT is_answered
+    ''', (question_id,))
+    if cursor.rowcount:
+        # Upserted, as a question moved by rebalancing may have no counter row on this shard
+        to_user_id = cursor.execute(
+            "SELECT to_user_id FROM questions WHERE question_id = ?", (question_id,)
+        ).fetchone()[0]
+        _count(cursor, to_user_id, unanswered=-1, answered=1)
+    return answer_id
+
+# Writes that can be grouped into one transaction by write_batch
+WRITERS = {
+    "question": _insert_question,
+    "answer": _insert_answer,
+}
+
+@metrics.timed("db")
+def add_question(from_user_id: int, to_user_id: int, question_text: str, media: tuple = None) -> int:
+    """Add a new question to the database, with an optional (media_type, file_id, file_unique_id)."""
+    try:
+        with transaction(shard=shard_of_user(to_user_id)) as cursor:
+            question_id = _insert_question(cursor, from_user_id, to_user_id, question_text, media)
+
+        logger.debug("Добавлен новый вопрос от %s к %s с ID %s", from_user_id, to_user_id, question_id)
         return question_id
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при добавлении вопроса: {e}")
+        logger.error("Ошибка при добавлении вопроса: %s", e)
         return None
 
+@metrics.timed("db")
+def write_batch(writes: list, shard: int = 0) -> list:
+    """
+    Run (kind, args) writes from WRITERS, all routed to the given shard, in one transaction and return their ids.
+    If the batch fails, each write is retried in its own transaction,
+    so a bad row only fails its own caller and gets None.
+    """
+    try:
+        with transaction(shard=shard) as cursor:
+            ids = [WRITERS[kind](cursor, *args) for kind, args in writes]
+
+        logger.debug("Записано строк в одной транзакции: %s", len(ids))
+        return ids
+    except sqlite3.Error as e:
+        logger.error("Ошибка при групповой записи, запись по одной строке: %s", e)
+
+    ids = []
+    for kind, args in writes:
+        try:
+            with transaction(shard=shard) as cursor:
+                ids.append(WRITERS[kind](cursor, *args))
+        except sqlite3.Error as e:
+            logger.error("Ошибка при записи %s: %s", kind, e)
+            ids.append(None)
+    return ids
+
+def _usernames(user_ids: set) -> dict:
+    """Usernames of users by id. Users live on shard 0, questions may be on any shard."""
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    if not user_ids:
+        return {}
+    return dict(get_connection().execute(
+        f"SELECT user_id, username FROM users WHERE user_id IN ({', '.join('?' * len(user_ids))})", user_ids
+    ).fetchall())
+
+def _with_usernames(questions: list) -> list:
+    """Replace the sender id, the second column of question rows, with the sender's username."""
+    usernames = _usernames({row[1] for row in questions})
+    return [(row[0], usernames.get(row[1]), *row[2:]) for row in questions]
+
+@metrics.timed("db")
 def get_unanswered_questions(user_id: int) -> list:
     """Get all unanswered questions for a user."""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT q.question_id, u.username as from_username, q.question_text, q.created_at
+        cursor = get_connection(shard_of_user(user_id)).execute('''
+            SELECT q.question_id, q.from_user_id, q.question_text, q.created_at, m.media_type
             FROM questions q
-            LEFT JOIN users u ON q.from_user_id = u.user_id
+            LEFT JOIN media m ON m.file_unique_id = q.file_unique_id
             WHERE q.to_user_id = ? AND q.is_answered = FALSE
             ORDER BY q.created_at DESC
         ''', (user_id,))
-        
-        questions = cursor.fetchall()
-        conn.close()
-        return questions
+        return _with_usernames(cursor.fetchall())
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при получении вопросов: {e}")
+        logger.error("Ошибка при получении вопросов: %s", e)
+        return []
+
+@metrics.timed("db")
+def get_unanswered_questions_page(user_id: int, limit: int, cursor: tuple = None, direction: str = "next") -> tuple:
+    """
+    Get one page of unanswered questions for a user, newest first.
+    cursor is the (created_at, question_id) of the row the page starts after:
+    "next" pages go to older questions, "prev" pages go to newer ones.
+    Returns (questions, has_older, has_newer).
+    """
+    query = '''
+        SELECT q.question_id, q.from_user_id, q.question_text, q.created_at, m.media_type
+        FROM questions q
+        LEFT JOIN media m ON m.file_unique_id = q.file_unique_id
+        WHERE q.to_user_id = ? AND q.is_answered = FALSE
+    '''
+    params = [user_id]
+    if cursor is None:
+        query += " ORDER BY q.created_at DESC, q.question_id DESC"
+    elif direction == "next":
+        query += " AND (q.created_at, q.question_id) < (?, ?) ORDER BY q.created_at DESC, q.question_id DESC"
+        params.extend(cursor)
+    else:
+        query += " AND (q.created_at, q.question_id) > (?, ?) ORDER BY q.created_at ASC, q.question_id ASC"
+        params.extend(cursor)
+    query += " LIMIT ?"
+    params.append(limit + 1)
+
+    try:
+        questions = _with_usernames(get_connection(shard_of_user(user_id)).execute(query, params).fetchall())
+    except sqlite3.Error as e:
+        logger.error("Ошибка при получении страницы вопросов: %s", e)
+        return [], False, False
+
+    has_more = len(questions) > limit
+    questions = questions[:limit]
+    if cursor is None:
+        return questions, has_more, False
+    if direction == "next":
+        return questions, has_more, True
+    questions.reverse()
+    return questions, True, has_more
+
+# Marks around matched terms in search snippets, replaced by the caller after escaping
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+SNIPPET_TOKENS = 12
+
+# Most matches of one search that are ranked, newest first
+SEARCH_MAX_CANDIDATES = 1000
+# Weights of question and answer texts in the ranking, and BM25 parameters
+SEARCH_WEIGHTS = (1.0, 0.5)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def _search_tokens(text: str) -> list:
+    """Split text into words roughly the way the unicode61 tokenizer with remove_diacritics does."""
+    folded = unicodedata.normalize("NFKD", (text or "").casefold())
+    return re.findall(r"\w+", "".join(char for char in folded if not unicodedata.combining(char)))
+
+def rank_search_results(terms: str, candidates: list) -> list:
+    """
+    Order (question_id, question_text, answer_text) candidates by BM25 over the candidates
+    themselves, ties broken by recency. Returns the question ids.
+    """
+    words = set(_search_tokens(terms))
+    if not candidates:
         return []
 
-def add_answer(question_id: int, answer_text: str) -> int:
-    """Add an answer to a question."""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Add answer
-        cursor.execute('''
-            INSERT INTO answers (question_id, answer_text)
-            VALUES (?, ?)
-        ''', (question_id, answer_text))
-        
-        answer_id = cursor.lastrowid
-        
-        # Mark question as answered
-        cursor.execute('''
-            UPDATE questions
-            SET is_answered = TRUE
-            WHERE question_id = ?
-        ''', (question_id,))
-        
-        conn.commit()
-        conn.close()
+    documents = [
+        (question_id, [Counter(_search_tokens(text)) for text in texts])
+        for question_id, *texts in candidates
+    ]
+    average_lengths = [
+        max(1.0, sum(sum(columns[i].values()) for _, columns in documents) / len(documents))
+        for i in range(len(SEARCH_WEIGHTS))
+    ]
+
+    def score(columns: list) -> float:
+        total = 0.0
+        for weight, counts, average_length in zip(SEARCH_WEIGHTS, columns, average_lengths):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * sum(counts.values()) / average_length)
+            for word in words:
+                frequency = counts[word]
+                total += weight * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return total
+
+    documents.sort(key=lambda document: (score(document[1]), document[0]), reverse=True)
+    return [question_id for question_id, _ in documents]
+
+def search_match_expression(user_id: int, terms: str) -> str:
+    """
+    Build an FTS5 query matching all terms in the given user's inbox.
+    Every term is quoted, so user input can't use FTS5 query syntax.
+    Returns None if there is nothing to search for.
+    """
+    words = terms.split()
+    if not words:
+        return None
+    quoted = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+    return f'owner:u{user_id} AND {{question_text answer_text}}: ({quoted})'
+
+@metrics.timed("db")
+def search_questions(user_id: int, terms: str, limit: int, offset: int = 0) -> tuple:
+    """
+    Full-text search over the questions a user received and their answers, best matches first.
+    Rows are (question_id, question_snippet, answer_snippet, created_at, is_answered),
+    with matched terms between SNIPPET_START and SNIPPET_END.
+    Returns (rows, has_more).
+    """
+    match = search_match_expression(user_id, terms)
+    if match is None:
+        return [], False
+
+    try:
+        connection = get_connection(shard_of_user(user_id))
+        # FTS5's bm25() reads the whole index entry of every term to weigh it against all
+        # inboxes, which gets slower as the table grows. Matches inside one inbox are few,
+        # so the newest of them are fetched and ranked here instead.
+        candidates = connection.execute('''
+            SELECT rowid, question_text, answer_text FROM questions_fts
+            WHERE questions_fts MATCH ?
+            ORDER BY rowid DESC LIMIT ?
+        ''', (match, SEARCH_MAX_CANDIDATES)).fetchall()
+
+        ranked = rank_search_results(terms, candidates)
+        page = ranked[offset:offset + limit]
+        if not page:
+            return [], False
+
+        rows = connection.execute(f'''
+            SELECT q.question_id,
+                   snippet(questions_fts, 1, ?, ?, '…', ?),
+                   snippet(questions_fts, 2, ?, ?, '…', ?),
+                   q.created_at, q.is_answered
+            FROM questions_fts
+            -- CROSS JOIN keeps the full-text match in the outer loop, so it runs once
+            CROSS JOIN questions q ON q.question_id = questions_fts.rowid
+            WHERE questions_fts MATCH ? AND questions_fts.rowid IN ({", ".join("?" * len(page))})
+        ''', (
+            SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS,
+            SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS,
+            match, *page,
+        )).fetchall()
+    except sqlite3.Error as e:
+        logger.error("Ошибка при поиске вопросов: %s", e)
+        return [], False
+
+    order = {question_id: position for position, question_id in enumerate(page)}
+    rows.sort(key=lambda row: order[row[0]])
+    return rows, len(ranked) > offset + limit
+
+# Rows fetched at a time while exporting a user's history
+EXPORT_BATCH_SIZE = 500
+
+def iter_user_history(user_id: int, batch_size: int = EXPORT_BATCH_SIZE):
+    """
+    Yield every question a user received with its answer, as (question_id, question_text, created_at,
+    is_answered, answer_text, answered_at, question_media, answer_media) rows, the last two being media types.
+    Rows are fetched batch_size at a time in inbox index order (unanswered first, then by time),
+    so the whole history is never held in memory and SQLite doesn't have to sort it.
+    Senders are not included, questions stay anonymous.
+    """
+    try:
+        cursor = get_connection(shard_of_user(user_id)).execute('''
+            SELECT q.question_id, q.question_text, q.created_at, q.is_answered,
+                   a.answer_text, a.created_at, qm.media_type, am.media_type
+            FROM questions q
+            LEFT JOIN answers a ON a.question_id = q.question_id
+            LEFT JOIN media qm ON qm.file_unique_id = q.file_unique_id
+            LEFT JOIN media am ON am.file_unique_id = a.file_unique_id
+            WHERE q.to_user_id = ?
+            ORDER BY q.is_answered, q.created_at, q.question_id
+        ''', (user_id,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    except sqlite3.Error as e:
+        logger.error("Ошибка при выгрузке истории пользователя %s: %s", user_id, e)
+        raise
+
+@metrics.timed("db")
+def add_answer(question_id: int, answer_text: str, media: tuple = None) -> int:
+    """Add an answer to a question, with an optional (media_type, file_id, file_unique_id)."""
+    try:
+        with transaction(shard=shard_of_question(question_id)) as cursor:
+            answer_id = _insert_answer(cursor, question_id, answer_text, media)
+
         return answer_id
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при добавлении ответа: {e}")
+        logger.error("Ошибка при добавлении ответа: %s", e)
         return None
 
+COUNTER_FIELDS = ("received", "unanswered", "answered", "asked")
+
+@metrics.timed("db")
+def get_user_counters(user_id: int) -> dict:
+    """
+    Get a user's question counters, all zero for a user without questions. Returns None on error.
+    A user's counters are the sum of their rows on every shard: questions they asked are
+    counted on the recipient's shard, and rebalancing moves questions without their counts.
+    """
+    try:
+        counters = dict.fromkeys(COUNTER_FIELDS, 0)
+        for shard in range(len(_shards)):
+            row = get_connection(shard).execute(f'''
+                SELECT {", ".join(COUNTER_FIELDS)} FROM user_counters WHERE user_id = ?
+            ''', (user_id,)).fetchone()
+            for field, value in zip(COUNTER_FIELDS, row or ()):
+                counters[field] += value
+        return counters
+    except sqlite3.Error as e:
+        logger.error("Ошибка при получении счётчиков пользователя %s: %s", user_id, e)
+        return None
+
+@metrics.timed("db")
 def get_question(question_id: int) -> dict:
     """Get question details."""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        row = get_connection(shard_of_question(question_id)).execute('''
             SELECT 
                 q.question_id, 
                 q.from_user_id,
-                u1.username as from_username,
+                NULL as from_username,
                 q.to_user_id,
-                u2.username as to_username,
+                NULL as to_username,
                 q.question_text, 
                 q.created_at,
                 a.answer_id, 
                 a.answer_text,
-                a.created_at as answer_created_at
+                a.created_at as answer_created_at,
+                qm.media_type as question_media_type,
+                qm.file_id as question_file_id,
+                am.media_type as answer_media_type,
+                am.file_id as answer_file_id
             FROM questions q
             LEFT JOIN answers a ON q.question_id = a.question_id
-            LEFT JOIN users u1 ON q.from_user_id = u1.user_id
-            LEFT JOIN users u2 ON q.to_user_id = u2.user_id
+            LEFT JOIN media qm ON qm.file_unique_id = q.file_unique_id
+            LEFT JOIN media am ON am.file_unique_id = a.file_unique_id
             WHERE q.question_id = ?
-        ''', (question_id,))
-        
-        question = cursor.fetchone()
-        conn.close()
-        return question
+        ''', (question_id,)).fetchone()
+        if row is None:
+            return None
+        usernames = _usernames({row[1], row[3]})
+        return (*row[:2], usernames.get(row[1]), row[3], usernames.get(row[3]), *row[5:])
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при получении вопроса: {e}")
+        logger.error("Ошибка при получении вопроса: %s", e)
         return None
 
+# Upsert that keeps created_at and never replaces a known username with NULL
+USER_UPSERT_SQL = '''
+    INSERT INTO users (user_id, username) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET username = COALESCE(excluded.username, users.username)
+'''
+
+@metrics.timed("db")
 def add_user(user_id: int, username: str):
     """Add a new user to the database or update their username if they already exist."""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Check if user already exists
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        existing_user = cursor.fetchone()
-        if existing_user:
-            logger.info(f"Пользователь {user_id} уже существует в базе данных.")
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username) VALUES (?, ?)
-        ''', (user_id, username))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Пользователь {user_id} ({username}) добавлен или обновлен.")
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при добавлении/обновлении пользователя {user_id}: {e}")
+        with transaction() as cursor:
+            cursor.execute(USER_UPSERT_SQL, (user_id, username))
+
+        logger.debug("Пользователь %s (%s) добавлен или обновлен.", user_id, username)
+    except sqlite3.Error as e:
+        logger.error("Ошибка при добавлении/обновлении пользователя %s: %s", user_id, e)
+
+@metrics.timed("db")
+def upsert_users(users: list) -> list:
+    """Upsert (user_id, username) pairs in one transaction and return the stored rows."""
+    try:
+        rows = []
+        with transaction() as cursor:
+            for user_id, username in users:
+                cursor.execute(USER_UPSERT_SQL + " RETURNING user_id, username, created_at", (user_id, username))
+                rows.append(cursor.fetchone())
+
+        logger.debug("Сохранено пользователей: %s", len(rows))
+        return rows
+    except sqlite3.Error as e:
+        logger.error("Ошибка при сохранении пользователей: %s", e)
+        return None
 
+@metrics.timed("db")
 def get_user(user_id: int):
     """Retrieve a user's data from the database."""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        
-        if user:
-            logger.info(f"Пользователь найден: ID={user[0]}, Username={user[1]}")
-        else:
-            logger.info(f"Пользователь с ID={user_id} не найден в базе данных")
-        
-        conn.close()
-        # Returns a tuple (user_id, username) or None
-        return user
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при получении пользователя {user_id}: {e}")
-        return None
\ No newline at end of file
+        cursor = get_connection().execute(
+            'SELECT user_id, username, created_at FROM users WHERE user_id = ?', (user_id,)
+        )
+        # Returns a tuple (user_id, username, created_at) or None
+        return cursor.fetchone()
+    except sqlite3.Error as e:
+        logger.error("Ошибка при получении пользователя %s: %s", user_id, e)
+        return None
+
+@metrics.timed("db")
+def set_user_blocked(user_id: int, blocked: bool):
+    """Mark a user who blocked the bot, so broadcasts skip them, or clear the mark."""
+    try:
+        with transaction() as cursor:
+            cursor.execute(
+                "UPDATE users SET blocked_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END WHERE user_id = ?",
+                (blocked, user_id),
+            )
+    except sqlite3.Error as e:
+        logger.error("Ошибка при отметке блокировки пользователя %s: %s", user_id, e)
+
+BROADCAST_RUNNING = "running"
+BROADCAST_DONE = "done"
+BROADCAST_CANCELLED = "cancelled"
+BROADCAST_FIELDS = ("broadcast_id", "text", "created_by", "status", "position", "sent", "blocked", "failed")
+
+@metrics.timed("db")
+def create_broadcast(text: str, created_by: int) -> int:
+    """Start a broadcast unless one is already running. Returns its id, or None."""
+    try:
+        with transaction() as cursor:
+            if cursor.execute("SELECT 1 FROM broadcasts WHERE status = ?", (BROADCAST_RUNNING,)).fetchone():
+                return None
+            cursor.execute("INSERT INTO broadcasts (text, created_by) VALUES (?, ?)", (text, created_by))
+            return cursor.lastrowid
+    except sqlite3.Error as e:
+        logger.error("Ошибка при создании рассылки: %s", e)
+        return None
+
+@metrics.timed("db")
+def get_broadcast(broadcast_id: int = None) -> dict:
+    """Get a broadcast with its progress, the running one if no id is given. Returns None if there is none."""
+    try:
+        where, params = ("broadcast_id = ?", (broadcast_id,)) if broadcast_id is not None else ("status = ?", (BROADCAST_RUNNING,))
+        row = get_connection().execute(f'''
+            SELECT {", ".join(BROADCAST_FIELDS)} FROM broadcasts WHERE {where}
+            ORDER BY broadcast_id LIMIT 1
+        ''', params).fetchone()
+        return dict(zip(BROADCAST_FIELDS, row)) if row else None
+    except sqlite3.Error as e:
+        logger.error("Ошибка при получении рассылки: %s", e)
+        return None
+
+@metrics.timed("db")
+def get_broadcast_recipients(after_user_id: int, limit: int) -> list:
+    """Next batch of user ids for a broadcast, in user_id order and skipping users who blocked the bot."""
+    try:
+        cursor = get_connection().execute('''
+            SELECT user_id FROM users
+            WHERE user_id > ? AND blocked_at IS NULL
+            ORDER BY user_id LIMIT ?
+        ''', (after_user_id, limit))
+        return [row[0] for row in cursor]
+    except sqlite3.Error as e:
+        logger.error("Ошибка при выборке получателей рассылки: %s", e)
+        return None
+
+@metrics.timed("db")
+def save_broadcast_progress(broadcast_id: int, position: int, sent: int, failed: int, blocked_user_ids: list) -> bool:
+    """
+    Record a finished batch: move the broadcast's cursor to position, add to its counters
+    and mark users who blocked the bot, all in one transaction.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.executemany(
+                "UPDATE users SET blocked_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+                [(user_id,) for user_id in blocked_user_ids],
+            )
+            cursor.execute('''
+                UPDATE broadcasts
+                SET position = ?, sent = sent + ?, blocked = blocked + ?, failed = failed + ?
+                WHERE broadcast_id = ?
+            ''', (position, sent, len(blocked_user_ids), failed, broadcast_id))
+        return True
+    except sqlite3.Error as e:
+        logger.error("Ошибка при сохранении прогресса рассылки %s: %s", broadcast_id, e)
+        return False
+
+@metrics.timed("db")
+def finish_broadcast(broadcast_id: int, status: str) -> bool:
+    """Mark a running broadcast as done or cancelled. Returns False if it wasn't running."""
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+                UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE broadcast_id = ? AND status = ?
+            ''', (status, broadcast_id, BROADCAST_RUNNING))
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error("Ошибка при завершении рассылки %s: %s", broadcast_id, e)
+        return False
+
+@metrics.timed("db")
+def load_user_data() -> dict:
+    """Load persisted user_data as {user_id: serialized data}."""
+    try:
+        cursor = get_connection().execute('SELECT user_id, data FROM persistence_user_data')
+        return dict(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error("Ошибка при загрузке user_data: %s", e)
+        return {}
+
+@metrics.timed("db")
+def load_conversations(name: str) -> dict:
+    """Load persisted states of a conversation handler as {serialized key: state}."""
+    try:
+        cursor = get_connection().execute(
+            'SELECT key, state FROM persistence_conversations WHERE name = ?', (name,)
+        )
+        return dict(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error("Ошибка при загрузке состояний диалога %s: %s", name, e)
+        return {}
+
+@metrics.timed("db")
+def save_persistence(user_data: dict, conversations: dict) -> bool:
+    """
+    Write changed user_data ({user_id: serialized data}) and conversation states
+    ({(name, serialized key): state}) in one transaction. None deletes the entry.
+    """
+    try:
+        with transaction() as cursor:
+            for user_id, data in user_data.items():
+                if data is None:
+                    cursor.execute('DELETE FROM persistence_user_data WHERE user_id = ?', (user_id,))
+                else:
+                    cursor.execute('''
+                        INSERT INTO persistence_user_data (user_id, data) VALUES (?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET data = excluded.data
+                    ''', (user_id, data))
+
+            for (name, key), state in conversations.items():
+                if state is None:
+                    cursor.execute(
+                        'DELETE FROM persistence_conversations WHERE name = ? AND key = ?', (name, key)
+                    )
+                else:
+                    cursor.execute('''
+                        INSERT INTO persistence_conversations (name, key, state) VALUES (?, ?, ?)
+                        ON CONFLICT(name, key) DO UPDATE SET state = excluded.state
+                    ''', (name, key, state))
+        return True
+    except sqlite3.Error as e:
+        logger.error("Ошибка при сохранении состояния диалогов: %s", e)
+        return False
+
+ARCHIVE_SCHEMA = "archive"
+
+def _attach_archive(archive_file: str, shard: int = 0):
+    """Attach the archive database to this thread's connection to a shard, creating its tables on first use."""
+    conn = get_connection(shard)
+    if any(row[1] == ARCHIVE_SCHEMA for row in conn.execute("PRAGMA database_list")):
+        return
+
+    conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (archive_file,))
+    conn.execute(f"PRAGMA {ARCHIVE_SCHEMA}.journal_mode=WAL")
+    enable_incremental_vacuum(ARCHIVE_SCHEMA, shard=shard)
+    with transaction(shard=shard) as cursor:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.questions (
+                question_id INTEGER PRIMARY KEY,
+                from_user_id INTEGER,
+                to_user_id INTEGER,
+                question_text TEXT,
+                created_at TIMESTAMP,
+                is_answered BOOLEAN,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                file_unique_id TEXT
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_archive_questions_archived
+            ON questions (archived_at)
+        ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.answers (
+                answer_id INTEGER PRIMARY KEY,
+                question_id INTEGER,
+                answer_text TEXT,
+                created_at TIMESTAMP,
+                file_unique_id TEXT
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_archive_answers_question
+            ON answers (question_id)
+        ''')
+        # Archives created before media questions lack the media column
+        for table in ("questions", "answers"):
+            columns = {row[1] for row in cursor.execute(f"PRAGMA {ARCHIVE_SCHEMA}.table_info({table})")}
+            if "file_unique_id" not in columns:
+                cursor.execute(f"ALTER TABLE {ARCHIVE_SCHEMA}.{table} ADD COLUMN file_unique_id TEXT")
+
+def _days_ago(days: int) -> str:
+    """datetime() modifier for a retention window, e.g. "-30 days"."""
+    return f"-{days} days"
+
+@metrics.timed("db")
+def archive_questions(archive_file: str, answered_days: int, unanswered_days: int, batch_size: int,
+                      shard: int = 0) -> int:
+    """
+    Move one batch of questions, with their answers, to the archive database:
+    answered ones whose last answer is older than answered_days and unanswered ones asked
+    more than unanswered_days ago (0 keeps them). Each batch is one short transaction, so live writes only wait for
+    a single batch. Copies replace what is already archived, so a batch interrupted
+    between the two database files is simply moved again. Every shard archives its own questions.
+    Returns the number of questions moved, or None on error.
+    """
+    try:
+        _attach_archive(archive_file, shard)
+        with transaction(shard=shard) as cursor:
+            ids = []
+            for is_answered, days in ((True, answered_days), (False, unanswered_days)):
+                if days <= 0 or len(ids) >= batch_size:
+                    continue
+                # An answer is never older than its question, so the question's age narrows the search
+                ids += [row[0] for row in cursor.execute('''
+                    SELECT question_id FROM questions q
+                    WHERE is_answered = ? AND created_at < datetime('now', ?)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM answers a
+                          WHERE a.question_id = q.question_id AND a.created_at >= datetime('now', ?)
+                      )
+                    ORDER BY created_at LIMIT ?
+                ''', (is_answered, _days_ago(days), _days_ago(days), batch_size - len(ids)))]
+            if not ids:
+                return 0
+
+            placeholders = ", ".join("?" * len(ids))
+            # Archived questions leave the inbox, the other counters are totals and keep them
+            cursor.execute(f'''
+                INSERT INTO user_counters (user_id, unanswered)
+                SELECT to_user_id, -count(*) FROM questions
+                WHERE question_id IN ({placeholders}) AND NOT is_answered
+                GROUP BY to_user_id
+                ON CONFLICT (user_id) DO UPDATE SET unanswered = unanswered + excluded.unanswered
+            ''', ids)
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.questions
+                    (question_id, from_user_id, to_user_id, question_text, created_at, is_answered, file_unique_id)
+                SELECT question_id, from_user_id, to_user_id, question_text, created_at, is_answered, file_unique_id
+                FROM questions WHERE question_id IN ({placeholders})
+            ''', ids)
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.answers
+                    (answer_id, question_id, answer_text, created_at, file_unique_id)
+                SELECT answer_id, question_id, answer_text, created_at, file_unique_id
+                FROM answers WHERE question_id IN ({placeholders})
+            ''', ids)
+            # Questions go first, so the answer triggers find no search index rows left to update
+            cursor.execute(f"DELETE FROM questions WHERE question_id IN ({placeholders})", ids)
+            cursor.execute(f"DELETE FROM answers WHERE question_id IN ({placeholders})", ids)
+
+        logger.debug("Перенесено в архив вопросов: %s", len(ids))
+        return len(ids)
+    except sqlite3.Error as e:
+        logger.error("Ошибка при переносе вопросов в архив: %s", e)
+        return None
+
+@metrics.timed("db")
+def purge_archive(archive_file: str, days: int, batch_size: int) -> int:
+    """
+    Delete one batch of questions archived more than days ago, with their answers.
+    Returns the number of questions deleted, or None on error.
+    """
+    try:
+        _attach_archive(archive_file)
+        with transaction() as cursor:
+            ids = [row[0] for row in cursor.execute(f'''
+                SELECT question_id FROM {ARCHIVE_SCHEMA}.questions
+                WHERE archived_at < datetime('now', ?)
+                ORDER BY archived_at LIMIT ?
+            ''', (_days_ago(days), batch_size))]
+            if not ids:
+                return 0
+
+            placeholders = ", ".join("?" * len(ids))
+            cursor.execute(f"DELETE FROM {ARCHIVE_SCHEMA}.answers WHERE question_id IN ({placeholders})", ids)
+            cursor.execute(f"DELETE FROM {ARCHIVE_SCHEMA}.questions WHERE question_id IN ({placeholders})", ids)
+        return len(ids)
+    except sqlite3.Error as e:
+        logger.error("Ошибка при очистке архива: %s", e)
+        return None
+
+@metrics.timed("db")
+def incremental_vacuum(pages: int, schema: str = "main", shard: int = 0) -> tuple:
+    """
+    Return up to `pages` (at least 1) free pages of a shard's database to the file system.
+    Returns (pages freed, free pages left), or None on error.
+    """
+    try:
+        with transaction(shard=shard) as cursor:
+            before = cursor.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+            # The pragma frees one page per step, and sqlite3 steps statements without
+            # result columns only once, so pages are freed one call at a time
+            for _ in range(min(before, pages)):
+                cursor.execute(f"PRAGMA {schema}.incremental_vacuum(1)")
+            left = cursor.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]
+        return before - left, left
+    except sqlite3.Error as e:
+        logger.error("Ошибка при incremental_vacuum для %s: %s", schema, e)
+        return None
@@ -0,0 +1,129 @@
+import html
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+
+import database
+import media
+
+# Telegram message length limit
+MAX_MESSAGE_LENGTH = 4096
+# Longer questions are shortened so that one question can't fill the whole digest
+MAX_QUESTION_LENGTH = 1000
+BUTTONS_PER_ROW = 8
+
+DIGEST_HEADER = "Ваши неотвеченные вопросы:\n\n"
+DIGEST_FOOTER = "Нажмите на номер вопроса, чтобы ответить."
+
+SEARCH_FOOTER = "Ответить: /answer <ID вопроса> <текст ответа>"
+
+# Longer questions are cut in the list of inline results
+INLINE_TITLE_LENGTH = 100
+SHARED_QUESTION_HEADER = "<b>Мне задали анонимный вопрос:</b>\n\n"
+
+
+def format_question(number: int, question: tuple) -> str:
+    """Format one (question_id, from_username, question_text, created_at, media_type) row as a digest entry."""
+    question_id, from_username, question_text, created_at, media_type = question
+    question_text = media.describe(media_type, question_text)
+    if len(question_text) > MAX_QUESTION_LENGTH:
+        question_text = question_text[:MAX_QUESTION_LENGTH - 1] + "…"
+    return f"{number}. {question_text}\n    {from_username or 'Аноним'}, {created_at}\n\n"
+
+
+def select_questions(questions: list, from_end: bool = False) -> list:
+    """
+    Pick as many questions as fit into one message, keeping their order.
+    Questions are taken from the start of the list, or from its end if from_end is set.
+    """
+    budget = MAX_MESSAGE_LENGTH - len(DIGEST_HEADER) - len(DIGEST_FOOTER)
+    # Size every entry with the widest number so that the final numbering always fits
+    widest = len(questions)
+    candidates = reversed(questions) if from_end else questions
+
+    selected = []
+    for question in candidates:
+        size = len(format_question(widest, question))
+        if size > budget:
+            break
+        budget -= size
+        selected.append(question)
+
+    if from_end:
+        selected.reverse()
+    return selected
+
+
+def render_digest(questions: list, navigation: list = None) -> tuple:
+    """
+    Render questions as one message with a numbered answer keyboard.
+    navigation is an optional row of buttons added under the numbers.
+    Returns (text, reply_markup).
+    """
+    text = DIGEST_HEADER + "".join(
+        format_question(number, question) for number, question in enumerate(questions, start=1)
+    ) + DIGEST_FOOTER
+
+    buttons = [
+        InlineKeyboardButton(str(number), callback_data=f"answer_{question[0]}")
+        for number, question in enumerate(questions, start=1)
+    ]
+    keyboard = [buttons[i:i + BUTTONS_PER_ROW] for i in range(0, len(buttons), BUTTONS_PER_ROW)]
+    if navigation:
+        keyboard.append(navigation)
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def highlight(snippet: str) -> str:
+    """Escape a search snippet for HTML and turn its match marks into bold text."""
+    return html.escape(snippet or "").replace(database.SNIPPET_START, "<b>").replace(database.SNIPPET_END, "</b>")
+
+
+def render_search(terms: str, results: list, offset: int, page_size: int, has_more: bool) -> tuple:
+    """
+    Render one page of database.search_questions results as an HTML message,
+    with Prev/Next buttons that carry the offset of the neighbouring pages.
+    Returns (text, reply_markup).
+    """
+    if not results:
+        return f"По запросу «{html.escape(terms)}» ничего не найдено.", None
+
+    lines = [f"Результаты поиска «{html.escape(terms)}»:\n"]
+    for number, (question_id, question, answer, created_at, is_answered) in enumerate(results, start=offset + 1):
+        status = "отвечен" if is_answered else "без ответа"
+        lines.append(f"{number}. {highlight(question)}")
+        if answer:
+            lines.append(f"    Ответ: {highlight(answer)}")
+        lines.append(f"    ID {question_id}, {created_at}, {status}\n")
+    lines.append(html.escape(SEARCH_FOOTER))
+
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton("« Назад", callback_data=f"search|{max(0, offset - page_size)}"))
+    if has_more:
+        navigation.append(InlineKeyboardButton("Далее »", callback_data=f"search|{offset + len(results)}"))
+    return "\n".join(lines), InlineKeyboardMarkup([navigation]) if navigation else None
+
+
+def question_matches(question: tuple, terms: str) -> bool:
+    """Whether a (question_id, from_username, question_text, created_at, media_type) row contains the typed terms."""
+    text = media.describe(question[4], question[2]).casefold()
+    return all(term in text for term in terms.casefold().split())
+
+
+def render_inline_result(question: tuple, personal_link: str) -> InlineQueryResultArticle:
+    """
+    Render an unanswered question as an inline result. Choosing it posts the question to the
+    chat, without its sender, with a button leading to the user's link for questions.
+    """
+    question_id, _, question_text, created_at, media_type = question
+    text = media.describe(media_type, question_text)
+    if len(text) > MAX_QUESTION_LENGTH:
+        text = text[:MAX_QUESTION_LENGTH - 1] + "…"
+    title = text if len(text) <= INLINE_TITLE_LENGTH else text[:INLINE_TITLE_LENGTH - 1] + "…"
+    return InlineQueryResultArticle(
+        id=str(question_id),
+        title=title,
+        description=str(created_at),
+        input_message_content=InputTextMessageContent(SHARED_QUESTION_HEADER + html.escape(text), parse_mode='HTML'),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Задать анонимный вопрос", url=personal_link)]]),
+    )
@@ -0,0 +1,125 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+# Exports are built in memory up to this size, larger ones spill to a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+# Telegram refuses documents larger than this from bots
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+# Exports built at the same time, each on its own thread and database connection
+EXPORT_WORKERS = 2
+# Faster than the default level 9 and barely larger on short texts
+GZIP_LEVEL = 6
+# How often, in rows, the size of an export being written is checked
+SIZE_CHECK_ROWS = 1000
+# Uploading a large document can take a while
+UPLOAD_TIMEOUT = 120  # seconds
+
+# question_media and answer_media hold the media type of voice, photo, video note and sticker messages
+FIELDS = ("question_id", "question_text", "created_at", "is_answered", "answer_text", "answered_at",
+          "question_media", "answer_media")
+
+# Exports read the database on their own threads, so a long export never holds up the DB worker
+_executor = None
+
+
+class ExportTooLarge(Exception):
+    """The finished export is larger than Telegram accepts."""
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+    return _executor
+
+
+# One encoder for all rows, json.dumps builds a new one on every call with non-default options
+_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def _write_jsonl(rows, out: io.TextIOBase):
+    for row in rows:
+        record = dict(zip(FIELDS, row))
+        record["is_answered"] = bool(record["is_answered"])
+        out.write(_encode(record) + "\n")
+
+
+def _write_csv(rows, out: io.TextIOBase):
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    writer.writerows(rows)
+
+
+WRITERS = {
+    "jsonl": _write_jsonl,
+    "csv": _write_csv,
+}
+
+
+def _within_limit(rows, spool):
+    """Pass rows through, giving up as soon as the file grows past MAX_DOCUMENT_SIZE."""
+    for count, row in enumerate(rows, start=1):
+        if count % SIZE_CHECK_ROWS == 0 and spool.tell() > MAX_DOCUMENT_SIZE:
+            raise ExportTooLarge(spool.tell())
+        yield row
+
+
+def build_export(user_id: int, fmt: str = "jsonl", compress: bool = False):
+    """
+    Write the user's received questions and answers to a spooled temporary file.
+    Rows are streamed from the database and written one by one, so memory use
+    doesn't depend on the size of the history. Returns the file, rewound.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        binary = gzip.GzipFile(fileobj=spool, mode="wb", compresslevel=GZIP_LEVEL) if compress else spool
+        # utf-8-sig lets spreadsheet programs detect the encoding of CSV files
+        text = io.TextIOWrapper(binary, encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+        WRITERS[fmt](_within_limit(database.iter_user_history(user_id), spool), text)
+        text.flush()
+        text.detach()
+        if compress:
+            binary.close()
+
+        size = spool.tell()
+        if size > MAX_DOCUMENT_SIZE:
+            raise ExportTooLarge(size)
+        spool.seek(0)
+        return spool
+    except BaseException:
+        spool.close()
+        raise
+
+
+def build_document(user_id: int, fmt: str = "jsonl", compress: bool = False) -> tuple:
+    """
+    Build an export, compressing it if it is too large for Telegram otherwise.
+    Returns (file, filename).
+    """
+    if not compress:
+        try:
+            return build_export(user_id, fmt), f"questions.{fmt}"
+        except ExportTooLarge:
+            pass
+    return build_export(user_id, fmt, compress=True), f"questions.{fmt}.gz"
+
+
+async def export(user_id: int, fmt: str = "jsonl", compress: bool = False) -> tuple:
+    """Run build_document on an export thread without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), build_document, user_id, fmt, compress)
+
+
+def shutdown():
+    """Wait for running exports and stop the export threads. Called on bot shutdown."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,117 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+from outbox import TokenBucket
+
+# Questions one sender may send: a burst of SENDER_BURST, then one every 1 / SENDER_RATE seconds
+SENDER_RATE = 1 / 10
+SENDER_BURST = 5
+# Questions one sender may send to the same target
+PAIR_RATE = 1 / 60
+PAIR_BURST = 3
+# Identical questions to the same target within this window are dropped
+DUPLICATE_WINDOW = 600  # seconds
+# Upper bound on tracked senders, pairs and question hashes each
+MAX_ENTRIES = 100000
+
+# Reasons returned by FloodGuard.check
+TOO_FAST = "too_fast"
+DUPLICATE = "duplicate"
+
+
+def question_hash(text: str) -> bytes:
+    """Hash of a question that ignores case and whitespace differences."""
+    normalized = " ".join((text or "").casefold().split())
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+
+class _Buckets:
+    """
+    Token buckets by key, least recently used first.
+    A bucket untouched for capacity / rate seconds is full again, so it is
+    evicted and recreated on demand, which keeps every lookup O(1) amortized.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_size: int, clock):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self.clock = clock
+        self.idle_after = capacity / rate
+        self._buckets = OrderedDict()
+
+    def get(self, key) -> TokenBucket:
+        now = self.clock()
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if now - oldest.updated < self.idle_after and len(self._buckets) < self.max_size:
+                break
+            self._buckets.popitem(last=False)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity, self.clock)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class FloodGuard:
+    """
+    In-memory flood control for incoming questions, checked before any database or network work:
+    a token bucket per sender, one per sender/target pair, and a window of recent question
+    hashes per target. Only used from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, sender_rate: float = SENDER_RATE, sender_burst: float = SENDER_BURST,
+                 pair_rate: float = PAIR_RATE, pair_burst: float = PAIR_BURST,
+                 duplicate_window: float = DUPLICATE_WINDOW, max_entries: int = MAX_ENTRIES,
+                 clock=time.monotonic):
+        self.duplicate_window = duplicate_window
+        self.max_entries = max_entries
+        self.clock = clock
+        self._senders = _Buckets(sender_rate, sender_burst, max_entries, clock)
+        self._pairs = _Buckets(pair_rate, pair_burst, max_entries, clock)
+        self._recent = OrderedDict()  # (to_user_id, hash) -> expiry, oldest first
+
+    def check(self, from_user_id: int, to_user_id: int, text: str) -> tuple:
+        """
+        Decide whether a question may be sent. Returns (None, 0) and records the question
+        if it may, otherwise (TOO_FAST, seconds to wait) or (DUPLICATE, 0).
+        """
+        now = self.clock()
+        self._expire(now)
+
+        key = (to_user_id, question_hash(text))
+        if key in self._recent:
+            return DUPLICATE, 0
+
+        sender = self._senders.get(from_user_id)
+        pair = self._pairs.get((from_user_id, to_user_id))
+        delay = max(sender.delay(), pair.delay())
+        if delay > 0:
+            return TOO_FAST, delay
+
+        sender.consume()
+        pair.consume()
+        self._recent[key] = now + self.duplicate_window
+        return None, 0
+
+    def forget(self, to_user_id: int, text: str):
+        """Drop a recorded question, e.g. when it could not be saved, so it can be sent again."""
+        self._recent.pop((to_user_id, question_hash(text)), None)
+
+    def _expire(self, now: float):
+        # Every entry lives for the same window, so the oldest ones are at the front
+        while self._recent:
+            key, expiry = next(iter(self._recent.items()))
+            if expiry > now and len(self._recent) < self.max_entries:
+                break
+            self._recent.popitem(last=False)
+
+
+guard = FloodGuard()
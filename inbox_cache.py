@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+
+# Newest questions of an inbox kept in the cache, older ones are read page by page
+INBOX_CACHE_ROWS = 500
+# Questions kept across all cached inboxes
+INBOX_CACHE_MAX_ROWS = 200000
+# How long a cached inbox is used. Writes through async_database drop the inboxes they
+# change right away, so this only bounds changes made elsewhere, such as archiving.
+INBOX_CACHE_TTL = 300  # seconds
+
+
+class InboxEntry:
+    """
+    A user's newest unanswered questions and the inline results already rendered for them,
+    by question_id. complete is False if the inbox has older questions than these.
+    """
+
+    __slots__ = ("questions", "complete", "results", "loaded_at")
+
+    def __init__(self, questions: list, complete: bool):
+        self.questions = questions
+        self.complete = complete
+        self.results = {}
+        self.loaded_at = time.monotonic()
+
+
+class InboxCache:
+    """
+    LRU cache of users' newest unanswered questions with a TTL, so that inline queries
+    sent while the user types don't each read and render the inbox again. Bounded by the
+    number of questions across all inboxes, as one inbox may hold many more than another.
+    Rows are as returned by database.get_unanswered_questions_page.
+    Used from the event loop only.
+    """
+
+    def __init__(self, max_rows: int = INBOX_CACHE_MAX_ROWS, ttl: float = INBOX_CACHE_TTL):
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._rows = 0
+        # Owner of every cached question, to find the inbox an answer changes
+        self._owners = {}
+        # Loads in progress, dropped by invalidate() so that they don't store what they read
+        self._loading = {}
+
+    def get(self, user_id: int) -> InboxEntry:
+        """Cached inbox of a user, or None if it isn't cached or has expired."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.loaded_at > self.ttl:
+            self._drop(user_id)
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    def load_started(self, user_id: int) -> object:
+        """Mark the start of a database read of an inbox. Pass the returned token to put()."""
+        token = self._loading[user_id] = object()
+        return token
+
+    def put(self, user_id: int, token: object, questions: list, complete: bool) -> InboxEntry:
+        """
+        Cache an inbox read since load_started() and return its entry. It isn't kept if the
+        inbox changed meanwhile, as the read may have missed the change.
+        """
+        entry = InboxEntry(questions, complete)
+        if self._loading.get(user_id) is not token:
+            return entry
+        del self._loading[user_id]
+
+        self._drop(user_id)
+        self._entries[user_id] = entry
+        self._rows += len(questions)
+        for question in questions:
+            self._owners[question[0]] = user_id
+        while self._rows > self.max_rows:
+            self._drop(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, user_id: int):
+        """Forget a user's inbox after a question was added to it."""
+        self._loading.pop(user_id, None)
+        self._drop(user_id)
+
+    def invalidate_question(self, question_id: int):
+        """Forget the inbox holding a question after it was answered."""
+        user_id = self._owners.get(question_id)
+        if user_id is not None:
+            self.invalidate(user_id)
+        else:
+            # The owner isn't known, so none of the loads in progress may keep what they read
+            self._loading.clear()
+
+    def _drop(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._rows -= len(entry.questions)
+            for question in entry.questions:
+                self._owners.pop(question[0], None)
+
+
+inbox = InboxCache()
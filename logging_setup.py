@@ -0,0 +1,164 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Records waiting for the writer thread, newer records are dropped when it falls this far behind
+LOG_QUEUE_SIZE = 10000
+
+# INFO and DEBUG records allowed per second for every distinct log line
+LOG_INFO_RATE = 10
+
+# Chatty third-party loggers, httpx logs every Bot API request at INFO
+QUIET_LOGGERS = ("httpx", "httpcore")
+
+# Whether question and answer texts are replaced in log lines, see body()
+redact_bodies = True
+
+_listener = None
+_queue_handler = None
+
+
+class _Body:
+    """Message text passed as a log argument, redacted when the record is formatted."""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        if redact_bodies:
+            return f"<скрыто, {len(self.text or '')} симв.>"
+        return str(self.text)
+
+
+def body(text):
+    """Wrap a message text for logging, so that it honours LOG_REDACT_BODIES."""
+    return _Body(text)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `rate` INFO and DEBUG records per second for every distinct log line,
+    i.e. every logger and message template. Warnings and errors always pass.
+    rates overrides the rate for single loggers, 0 drops all their INFO lines.
+    """
+
+    def __init__(self, rate: float = LOG_INFO_RATE, rates: dict = None):
+        super().__init__()
+        self.rate = rate
+        self.rates = rates or {}
+        self.suppressed = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(record.name, self.rate)
+        if rate <= 0:
+            self.suppressed += 1
+            return False
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if not allowed:
+                self.suppressed += 1
+        return allowed
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread as they are. The stock QueueHandler formats
+    the message in the calling thread, here that is left to the writer thread.
+    Never blocks: when the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _parse_rates(value: str) -> dict:
+    """Parse LOG_INFO_RATES such as "database=1,main=20" into {logger name: rate}."""
+    rates = {}
+    for item in value.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_logging():
+    """
+    Configure logging for the whole bot from the environment. Records are put on a queue
+    and written to stderr by a background thread, so logging never blocks the event loop.
+
+    LOG_LEVEL          root level, INFO by default
+    LOG_INFO_RATE      INFO lines per second allowed for every distinct log line
+    LOG_INFO_RATES     per-logger overrides, e.g. "database=1,main=20"
+    LOG_REDACT_BODIES  1 (default) hides question and answer texts, 0 logs them
+    """
+    global _listener, _queue_handler, redact_bodies
+    if _listener is not None:
+        return
+
+    redact_bodies = os.getenv("LOG_REDACT_BODIES", "1") != "0"
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _queue_handler = _QueueHandler(log_queue)
+    _queue_handler.addFilter(RateLimitFilter(
+        float(os.getenv("LOG_INFO_RATE", str(LOG_INFO_RATE))),
+        _parse_rates(os.getenv("LOG_INFO_RATES", "")),
+    ))
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    root.addHandler(_queue_handler)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out the records still queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped() -> int:
+    """Records not written because the queue was full or their line was rate limited."""
+    if _queue_handler is None:
+        return 0
+    return _queue_handler.dropped + sum(
+        log_filter.suppressed for log_filter in _queue_handler.filters if isinstance(log_filter, RateLimitFilter)
+    )
@@ -1,32 +1,102 @@
 import logging
+import math
 import os
 
 from dotenv import load_dotenv
-from telegram import Update, Bot, Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, ConversationHandler
+from telegram import Update, Bot, ChatMember, InputFile, InlineKeyboardButton
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, ChatMemberHandler, ConversationHandler, InlineQueryHandler
 
+import async_database
+import broadcast
 import database
+import digest
+import export
+import flood_control
+import logging_setup
+import media
+import metrics
+import migrations
+import outbox
+from persistence import SQLitePersistence
+import retention
+import update_processor
+import user_cache
 
 # Global variable to store bot username
 BOT_USERNAME = None
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Server exposing metrics, started in post_init
+metrics_server = None
+
 logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Enable logging
+logging_setup.setup_logging()
+
 # Get the bot token from environment variables
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 if not TOKEN or TOKEN == "YOUR_TOKEN_HERE":
     raise ValueError("Не найден TELEGRAM_BOT_TOKEN в .env файле. Пожалуйста, добавьте его.")
 
+# How updates are received: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+
+# Webhook settings, used only when BOT_MODE=webhook
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base URL of the reverse proxy
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Local Prometheus endpoint, off unless METRICS_PORT is set, e.g. METRICS_PORT=9464
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or "0")
+
+# Retention, off by default: answered questions are moved to the archive database this many
+# days after their last answer, unanswered ones this many days after they were asked, and
+# archived ones are deleted after ARCHIVE_RETENTION_DAYS. 0 keeps them. Archived questions
+# are no longer shown by /questions, /search and /export.
+ANSWERED_RETENTION_DAYS = int(os.getenv("ANSWERED_RETENTION_DAYS", "0"))
+UNANSWERED_RETENTION_DAYS = int(os.getenv("UNANSWERED_RETENTION_DAYS", "0"))
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "0"))
+ARCHIVE_DATABASE_FILE = os.getenv("ARCHIVE_DATABASE_FILE", "archive.db")
+
+# Updates of different users processed at the same time, 1 processes them one by one.
+# Updates received while the bot is this far behind are left waiting on Telegram's side.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", str(update_processor.MAX_CONCURRENT_UPDATES)))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", str(update_processor.MAX_PENDING_UPDATES)))
+
+# Database files questions are spread over by recipient. Changing it on an existing
+# database takes a rebalance first: python -m sharding --from OLD --to NEW
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+
+# Telegram user IDs allowed to use admin commands, comma separated
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
 # States for ConversationHandler
 ASKING_QUESTION = 1
+ASKING_ANSWER = 2
+
+# Most questions fetched for one digest page, the digest shows as many as fit in a message
+DIGEST_MAX_QUESTIONS = 50
+
+# Search results shown per page
+SEARCH_PAGE_SIZE = 5
+
+# Inline results sent per answer, Telegram accepts at most 50
+INLINE_PAGE_SIZE = 50
+# How long Telegram reuses a user's inline results before asking the bot again
+INLINE_CACHE_TIME = 10  # seconds
+# Most questions read past the cached ones to fill one filtered inline page
+INLINE_SCAN_ROWS = 500
+
+# Users whose export is being prepared, so that /export can't be started twice at once
+exporting_users = set()
 
 # --- Bot Commands ---
 
@@ -35,16 +105,13 @@ async def getlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # Add user to database if not exists
-    database.add_user(user.id, user.username or user.first_name)
-    
-    # Get bot username
-    bot = await context.bot.get_me()
-    bot_username = bot.username
+    await async_database.add_user(user.id, user.username or user.first_name)
     
     # Create personal link
-    personal_link = f"https://t.me/{bot_username}?start={user.id}"
+    personal_link = await build_personal_link(context, user.id)
     
-    await update.message.reply_text(
+    outbox.reply(
+        update.message,
         "Ваша персональная ссылка для получения анонимных вопросов:\n\n"
         f"<code>{personal_link}</code>\n\n"
         "Покажите эту ссылку друзьям и подписчикам, чтобы они могли задавать вам анонимные вопросы!",
@@ -63,31 +130,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         if args:
             target_user_id = int(args[0])
-            target_user_info = database.get_user(target_user_id)
+            target_user_info = await async_database.get_user(target_user_id)
 
             # Add user to database if not exists
-            database.add_user(target_user_id, None)
+            await async_database.add_user(target_user_id, None)
             
             context.user_data['target_user_id'] = target_user_id
-            logger.info(f"Установлен target_user_id для пользователя {user.id}: {target_user_id}")
+            logger.info("Установлен target_user_id для пользователя %s: %s", user.id, target_user_id)
             
             target_username = target_user_info[1] if target_user_info else "пользователю"
-            await update.message.reply_text(
+            outbox.reply(
+                update.message,
                 f"Привет! Вы собираетесь задать анонимный вопрос {target_username}.\n\n"
-                "Просто отправьте свой вопрос следующим сообщением."
+                "Просто отправьте свой вопрос следующим сообщением: текстом, голосовым, фото, кружком или стикером."
             )
             return ASKING_QUESTION
         else:
-            await update.message.reply_html(
+            outbox.reply(
+                update.message,
                 f"Привет, {user.mention_html()}!\n\n"
                 "Я бот для сбора анонимных вопросов.\n\n"
                 "Для получения вашей персональной ссылки используйте команду /getlink\n\n"
-                "Чтобы отправить анонимный вопрос другому пользователю, перейдите по его персональной ссылке и напишите вопрос."
+                "Чтобы отправить анонимный вопрос другому пользователю, перейдите по его персональной ссылке и напишите вопрос.",
+                parse_mode='HTML'
             )
             return ConversationHandler.END
     except (ValueError, IndexError) as e:
-        logger.error(f"Ошибка при обработке аргументов start: {e}")
-        await update.message.reply_text("Неверная ссылка. Пожалуйста, используйте правильную ссылку.")
+        logger.error("Ошибка при обработке аргументов start: %s", e)
+        outbox.reply(update.message, "Неверная ссылка. Пожалуйста, используйте правильную ссылку.")
         return ConversationHandler.END
 
 
@@ -97,7 +167,7 @@ async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     
     if not args or len(args) < 2:
-        await update.message.reply_text("Использование: /answer <ID вопроса> <текст ответа>")
+        outbox.reply(update.message, "Использование: /answer <ID вопроса> <текст ответа>")
         return
     
     try:
@@ -105,32 +175,26 @@ async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
         answer_text = ' '.join(args[1:])
         
         # Add answer to database
-        answer_id = database.add_answer(question_id, answer_text)
+        answer_id = await async_database.add_answer(question_id, answer_text)
         if not answer_id:
-            await update.message.reply_text("Не удалось сохранить ответ. Пожалуйста, попробуйте снова.")
+            outbox.reply(update.message, "Не удалось сохранить ответ. Пожалуйста, попробуйте снова.")
             return
 
         # Get question details
-        question = database.get_question(question_id)
+        question = await async_database.get_question(question_id)
         if not question:
-            await update.message.reply_text("Вопрос не найден.")
+            outbox.reply(update.message, "Вопрос не найден.")
             return
 
         # Notify question sender
-        try:
-            await context.bot.send_message(
-                chat_id=question[1],  # from_user_id
-                text="Ваш вопрос был ответлен!"
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление отправителю вопроса: {e}")
+        outbox.send_message(question[1], "Ваш вопрос был ответлен!")  # from_user_id
 
-        await update.message.reply_text("Ответ сохранен и отправитель уведомлен!")
+        outbox.reply(update.message, "Ответ сохранен и отправитель уведомлен!")
     except ValueError:
-        await update.message.reply_text("Неверный формат ID вопроса.")
+        outbox.reply(update.message, "Неверный формат ID вопроса.")
     except Exception as e:
-        logger.error(f"Ошибка при ответе на вопрос: {e}")
-        await update.message.reply_text("Произошла ошибка при ответе на вопрос. Пожалуйста, попробуйте снова.")
+        logger.error("Ошибка при ответе на вопрос: %s", e)
+        outbox.reply(update.message, "Произошла ошибка при ответе на вопрос. Пожалуйста, попробуйте снова.")
 
 
 async def get_my_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -138,14 +202,12 @@ async def get_my_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     Generates a personal link for the user to collect anonymous questions.
     """
     user = update.effective_user
-    database.add_user(user.id, user.username or user.first_name)
-    
-    bot = await context.bot.get_me()
-    bot_username = bot.username
+    await async_database.add_user(user.id, user.username or user.first_name)
     
-    personal_link = f"https://t.me/{bot_username}?start={user.id}"
+    personal_link = await build_personal_link(context, user.id)
     
-    await update.message.reply_text(
+    outbox.reply(
+        update.message,
         "Вот ваша персональная ссылка для сбора анонимных вопросов:\n\n"
         f"`{personal_link}`\n\n"
         "Поделитесь ей, и когда кто-то напишет вопрос по этой ссылке, я перешлю его вам.",
@@ -161,123 +223,485 @@ async def handle_question(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         target_user_id = context.user_data.get('target_user_id')
         if not target_user_id:
             logger.error("target_user_id не найден в user_data")
-            await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте перейти по ссылке еще раз.")
+            outbox.reply(update.message, "Произошла ошибка. Пожалуйста, попробуйте перейти по ссылке еще раз.")
             return ConversationHandler.END
 
         message = update.message
-        logger.info(f"Получен вопрос от пользователя {message.from_user.id} для пользователя {target_user_id}")
-        logger.info(f"Текст вопроса: {message.text}")
-        
-        # Add sender to database if not exists
-        sender_id = message.from_user.id
-        sender_username = message.from_user.username or message.from_user.first_name
-        database.add_user(sender_id, sender_username)
-        
-        # Add recipient to database if not exists
-        database.add_user(target_user_id, None)  # We don't have recipient's username here
-        
+        # Voice, photo, video note and sticker questions are kept as Telegram file references
+        question_media = media.from_message(message)
+        question_text = message.caption if question_media else message.text
+        # The same file with the same caption counts as a repeated question
+        content = f"{question_media[2]}\n{question_text or ''}" if question_media else question_text
+
+        # Checked before flood control, so that a question to oneself uses up no rate limit
         if message.from_user.id == target_user_id:
             logger.info("Пользователь пытается отправить вопрос самому себе")
-            await message.reply_text("Вы не можете отправлять анонимные вопросы самому себе.")
+            outbox.reply(message, "Вы не можете отправлять анонимные вопросы самому себе.")
             return ConversationHandler.END
 
+        # Reject floods and repeated questions before doing any work
+        rejected, retry_after = flood_control.guard.check(message.from_user.id, target_user_id, content)
+        if rejected == flood_control.DUPLICATE:
+            outbox.reply(message, "Такой вопрос уже был отправлен этому пользователю.")
+            return ConversationHandler.END
+        if rejected == flood_control.TOO_FAST:
+            outbox.reply(
+                message,
+                f"Вы отправляете вопросы слишком часто. Попробуйте снова через {math.ceil(retry_after)} с."
+            )
+            return ASKING_QUESTION
+
+        # Add sender to database if not exists
+        sender_id = message.from_user.id
+        sender_username = message.from_user.username or message.from_user.first_name
+        await async_database.add_user(sender_id, sender_username)
+
         # Save question to database
-        question_id = database.add_question(message.from_user.id, target_user_id, message.text)
+        question_id = await async_database.add_question(
+            message.from_user.id, target_user_id, question_text, question_media
+        )
         if not question_id:
             logger.error("Не удалось сохранить вопрос в базу данных")
-            await message.reply_text("Произошла ошибка при сохранении вопроса. Пожалуйста, попробуйте снова.")
+            flood_control.guard.forget(target_user_id, content)
+            outbox.reply(message, "Произошла ошибка при сохранении вопроса. Пожалуйста, попробуйте снова.")
             return ConversationHandler.END
 
-        # Get bot username
+        # Create personal link from the cached bot username
         try:
-            bot = await context.bot.get_me()
-            bot_username = bot.username
-            logger.info(f"Имя бота: {bot_username}")
+            personal_link = await build_personal_link(context, target_user_id)
         except Exception as e:
-            logger.error(f"Ошибка при получении имени бота: {e}")
-            await message.reply_text("Произошла ошибка при получении имени бота. Пожалуйста, попробуйте снова.")
+            logger.error("Ошибка при получении имени бота: %s", e)
+            outbox.reply(message, "Произошла ошибка при получении имени бота. Пожалуйста, попробуйте снова.")
             return ConversationHandler.END
 
-        # Create personal link
-        personal_link = f"https://t.me/{bot_username}?start={target_user_id}"
-        logger.info(f"Создана персональная ссылка: {personal_link}")
+        # Unread badge from the recipient's counters, left out if they can't be read
+        counters = await async_database.get_user_counters(target_user_id)
+        badge = f"📬 Неотвеченных вопросов: {counters['unanswered']}\n\n" if counters else ""
 
         # Notify recipient with question and link
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=f"<b>У тебя новый анонимный вопрос:</b>\n\n"
-                     f"{message.text}\n\n"
-                     "✅ <b>Ответ отправлен!</b>\n\n"
-                     f"<b>Твоя ссылка для вопросов:</b>\n"
-                     f"<code>{personal_link}</code>\n\n"
-                     "Покажи эту ссылку друзьям и подписчикам и получай от них анонимные вопросы!",
-                parse_mode='HTML'
-            )
-            logger.info(f"Вопрос и ссылка отправлены пользователю {target_user_id}")
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление пользователю {target_user_id}: {e}")
-            await message.reply_text("Произошла ошибка при отправке вопроса. Пожалуйста, попробуйте снова.")
-            return ConversationHandler.END
+        outbox.send_message(
+            target_user_id,
+            f"<b>У тебя новый анонимный вопрос:</b>\n\n"
+            f"{media.describe(question_media and question_media[0], question_text)}\n\n"
+            f"{badge}"
+            "✅ <b>Ответ отправлен!</b>\n\n"
+            f"<b>Твоя ссылка для вопросов:</b>\n"
+            f"<code>{personal_link}</code>\n\n"
+            "Покажи эту ссылку друзьям и подписчикам и получай от них анонимные вопросы!",
+            parse_mode='HTML'
+        )
+        if question_media:
+            # Sent by file_id right after the notification, Telegram reuses the stored file
+            media.send(target_user_id, question_media[0], question_media[1])
+        logger.info(
+            "Вопрос %s от пользователя %s для пользователя %s: %s",
+            question_id, sender_id, target_user_id,
+            logging_setup.body(media.describe(question_media and question_media[0], question_text))
+        )
 
-        await message.reply_text("Спасибо! Ваш вопрос был отправлен анонимно.")
+        outbox.reply(message, "Спасибо! Ваш вопрос был отправлен анонимно.")
         context.user_data.pop('target_user_id', None)
-        logger.info(f"target_user_id удален из user_data для пользователя {message.from_user.id}")
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Ошибка в handle_question: {e}")
-        await update.message.reply_text("Произошла ошибка при обработке вашего вопроса. Пожалуйста, попробуйте снова.")
+        logger.error("Ошибка в handle_question: %s", e)
+        outbox.reply(update.message, "Произошла ошибка при обработке вашего вопроса. Пожалуйста, попробуйте снова.")
         return ConversationHandler.END
     return ConversationHandler.END
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
-    await update.message.reply_text("Действие отменено.")
+    outbox.reply(update.message, "Действие отменено.")
     context.user_data.pop('target_user_id', None)
     return ConversationHandler.END
 
 
-async def get_bot_username(context: ContextTypes.DEFAULT_TYPE):
-    bot = await context.bot.get_me()
-    return bot.username
+async def refresh_bot_username(bot: Bot) -> str:
+    """Fetch the bot identity from Telegram and update the cached username."""
+    global BOT_USERNAME
+    me = await bot.get_me()
+    BOT_USERNAME = me.username
+    logger.info("Имя бота: %s", BOT_USERNAME)
+    return BOT_USERNAME
+
+
+async def get_bot_username(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Return the cached bot username, fetching it only if it is not cached yet."""
+    if BOT_USERNAME is None:
+        return await refresh_bot_username(context.bot)
+    return BOT_USERNAME
+
+
+async def build_personal_link(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> str:
+    """Build the deep link used to ask a user anonymous questions."""
+    bot_username = await get_bot_username(context)
+    return f"https://t.me/{bot_username}?start={user_id}"
+
+
+async def post_init(application: Application) -> None:
+    """Resolve and cache the bot identity once at startup, start the outbound queue and metrics."""
+    global metrics_server
+    await refresh_bot_username(application.bot)
+    outbox.scheduler.start(application.bot)
+
+    metrics.gauge("pending_updates", application.update_queue.qsize)
+    if isinstance(application.update_queue, update_processor.UpdateQueue):
+        metrics.gauge("updates_in_progress", application.update_queue.processor.pending)
+    metrics.gauge("outbox_pending", lambda: outbox.scheduler.pending())
+    metrics.gauge("db_queue", async_database.queue_depth)
+    metrics.gauge("log_dropped", logging_setup.dropped)
+    if METRICS_PORT:
+        # Metrics are optional, a taken port must not keep the bot from starting
+        try:
+            metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error("Не удалось запустить сервер метрик на %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+
+
+async def post_stop(application: Application) -> None:
+    """Commit pending writes and deliver queued outgoing messages before the bot shuts down."""
+    global metrics_server
+    await async_database.flush_writes()
+    await outbox.scheduler.stop()
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+
+async def flush_users(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodically write pending user changes to the database."""
+    await async_database.flush_users()
+
+
+async def run_backfills(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Finish slow migration steps in the background after startup."""
+    await migrations.run_backfills()
+
+
+async def archive_questions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodically move old questions to the archive database and shrink the database file."""
+    await retention.run_retention(
+        ARCHIVE_DATABASE_FILE, ANSWERED_RETENTION_DAYS, UNANSWERED_RETENTION_DAYS, ARCHIVE_RETENTION_DAYS
+    )
 
 
 async def view_questions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show user's unanswered questions."""
-    user = update.effective_user
-    questions = database.get_unanswered_questions(user.id)
-    
+    """Show user's unanswered questions as a single digest message."""
+    text, reply_markup, page = await build_questions_digest(update.effective_user.id)
+    context.user_data['digest_page'] = page
+    outbox.reply(update.message, text, reply_markup=reply_markup)
+
+
+async def questions_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Switch the digest to the next or previous page when a navigation button is pressed."""
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        _, direction, created_at, question_id = query.data.split('|')
+        cursor = (created_at, int(question_id))
+    except ValueError:
+        logger.error("Неверные данные навигации: %s", query.data)
+        return
+
+    text, reply_markup, page = await build_questions_digest(query.from_user.id, cursor, direction)
+    context.user_data['digest_page'] = page
+    outbox.edit_message_text(query.message.chat_id, query.message.message_id, text, reply_markup=reply_markup)
+
+
+async def build_questions_digest(user_id: int, cursor: tuple = None, direction: str = "next") -> tuple:
+    """
+    Render one page of unanswered questions as a digest with Prev/Next navigation buttons.
+    Returns (text, reply_markup, page), where page is the (cursor, direction) actually shown.
+    """
+    questions, has_older, has_newer = await async_database.get_unanswered_questions_page(
+        user_id, DIGEST_MAX_QUESTIONS, cursor, direction
+    )
+
+    if not questions and cursor is not None:
+        # Everything on this page was answered, start over from the newest questions
+        return await build_questions_digest(user_id)
     if not questions:
-        await update.message.reply_text("У вас нет новых вопросов.")
+        return "У вас нет новых вопросов.", None, (None, "next")
+
+    # Previous pages are filled from the end closest to the cursor
+    from_end = cursor is not None and direction == "prev"
+    shown = digest.select_questions(questions, from_end)
+    if len(shown) < len(questions):
+        if from_end:
+            has_newer = True
+        else:
+            has_older = True
+
+    # Keyset cursors point at the first and last question of this page
+    navigation = []
+    if has_newer:
+        first = shown[0]
+        navigation.append(InlineKeyboardButton("« Назад", callback_data=f"page|prev|{first[3]}|{first[0]}"))
+    if has_older:
+        last = shown[-1]
+        navigation.append(InlineKeyboardButton("Далее »", callback_data=f"page|next|{last[3]}|{last[0]}"))
+
+    text, reply_markup = digest.render_digest(shown, navigation)
+    return text, reply_markup, (cursor, direction)
+
+
+async def refresh_digest(user_id: int, user_data: dict):
+    """Re-render the digest message the user answered from, in place."""
+    digest_message = user_data.get('digest_message')
+    if not digest_message:
+        return
+
+    cursor, direction = user_data.get('digest_page') or (None, "next")
+    text, reply_markup, page = await build_questions_digest(user_id, cursor, direction)
+    user_data['digest_page'] = page
+    chat_id, message_id = digest_message
+    outbox.edit_message_text(chat_id, message_id, text, reply_markup=reply_markup)
+
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Search the user's received questions and answers: /search <terms>."""
+    terms = " ".join(context.args or [])
+    if not terms:
+        outbox.reply(update.message, "Использование: /search <слова для поиска>")
+        return
+
+    context.user_data['search_terms'] = terms
+    text, reply_markup = await build_search_page(update.effective_user.id, terms, 0)
+    outbox.reply(update.message, text, reply_markup=reply_markup, parse_mode='HTML')
+
+
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Switch search results to another page when a navigation button is pressed."""
+    query = update.callback_query
+    await query.answer()
+
+    terms = context.user_data.get('search_terms')
+    try:
+        offset = int(query.data.split('|')[1])
+    except (IndexError, ValueError):
+        logger.error("Неверные данные навигации поиска: %s", query.data)
+        return
+    if not terms:
+        outbox.reply(query.message, "Поиск устарел. Пожалуйста, повторите команду /search.")
         return
-    
-    for q in questions:
-        question_id, from_username, question_text, created_at = q
-        
-        # Create answer command
-        answer_command = f"/answer_{question_id}"
-        
-        await update.message.reply_text(
-            f"Новый анонимный вопрос:\n\n"
-            f"{question_text}\n\n"
-            f"Отправитель: {from_username or 'Аноним'}\n"
-            f"Дата: {created_at}\n\n"
-            f"Ответить: {answer_command}",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Ответить", callback_data=f"answer_{question_id}")]
-            ])
-        )
+
+    text, reply_markup = await build_search_page(query.from_user.id, terms, offset)
+    outbox.edit_message_text(
+        query.message.chat_id, query.message.message_id, text, reply_markup=reply_markup, parse_mode='HTML'
+    )
+
+
+async def build_search_page(user_id: int, terms: str, offset: int) -> tuple:
+    """Run a search in the user's inbox and render one page of results. Returns (text, reply_markup)."""
+    results, has_more = await async_database.search_questions(user_id, terms, SEARCH_PAGE_SIZE, offset)
+    return digest.render_search(terms, results, offset, SEARCH_PAGE_SIZE, has_more)
+
+
+async def inline_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Show the user's unanswered questions in inline mode (@bot in any chat), filtered by the
+    typed text, so that one can be shared. The newest questions and their rendered results
+    come from the inbox cache, older ones are read from the database. Pages are requested by
+    Telegram with the keyset cursor returned in next_offset.
+    """
+    query = update.inline_query
+    user_id = query.from_user.id
+    try:
+        created_at, question_id = query.offset.split('|')
+        cursor = (created_at, int(question_id))
+    except ValueError:
+        cursor = None
+
+    try:
+        entry = await async_database.get_inbox(user_id)
+        page, cursor = await build_inline_page(user_id, entry, query.query.strip(), cursor)
+
+        results = []
+        personal_link = None
+        for question, cached in page:
+            result = entry.results.get(question[0])
+            if result is None:
+                personal_link = personal_link or await build_personal_link(context, user_id)
+                result = digest.render_inline_result(question, personal_link)
+                if cached:
+                    entry.results[question[0]] = result
+            results.append(result)
+
+        next_offset = f"{cursor[0]}|{cursor[1]}" if cursor else ""
+        # Results are personal, Telegram must not show them to other users typing the same text
+        await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, next_offset=next_offset)
+    except Exception as e:
+        logger.error("Ошибка при ответе на inline-запрос пользователя %s: %s", user_id, e)
+
+
+async def build_inline_page(user_id: int, entry, terms: str, cursor: tuple) -> tuple:
+    """
+    Pick the questions of an inline page after the keyset cursor, matching the terms:
+    from the cached inbox first, then from the database if the cache doesn't hold all of it.
+    Returns ([(question, cached), ...], cursor of the next page or None).
+    """
+    def matches(question: tuple) -> bool:
+        return not terms or digest.question_matches(question, terms)
+
+    page = []
+    for question in entry.questions:
+        if cursor is not None and (question[3], question[0]) >= cursor:
+            continue
+        if len(page) == INLINE_PAGE_SIZE:
+            return page, (page[-1][0][3], page[-1][0][0])
+        if matches(question):
+            page.append((question, True))
+    if entry.complete:
+        return page, None
+    if len(page) == INLINE_PAGE_SIZE:
+        return page, (page[-1][0][3], page[-1][0][0])
+
+    # Past the cached questions, filtered pages read a bounded number of rows at a time
+    if entry.questions and (cursor is None or (entry.questions[-1][3], entry.questions[-1][0]) < cursor):
+        cursor = (entry.questions[-1][3], entry.questions[-1][0])
+    limit = INLINE_SCAN_ROWS if terms else INLINE_PAGE_SIZE - len(page)
+    questions, has_older, _ = await async_database.get_unanswered_questions_page(user_id, limit, cursor)
+    for question in questions:
+        if len(page) == INLINE_PAGE_SIZE:
+            return page, (page[-1][0][3], page[-1][0][0])
+        if matches(question):
+            page.append((question, False))
+    if not has_older or not questions:
+        return page, None
+    return page, (questions[-1][3], questions[-1][0])
+
+
+async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the user's received questions and answers as a file: /export [jsonl|csv] [gz]."""
+    user = update.effective_user
+    args = [arg.lower() for arg in context.args or []]
+    if any(arg not in export.WRITERS and arg != "gz" for arg in args):
+        outbox.reply(update.message, "Использование: /export [jsonl|csv] [gz]")
+        return
+    fmt = next((arg for arg in args if arg in export.WRITERS), "jsonl")
+    compress = "gz" in args
+
+    if user.id in exporting_users:
+        outbox.reply(update.message, "Выгрузка уже готовится, подождите немного.")
+        return
+
+    exporting_users.add(user.id)
+    try:
+        outbox.reply(update.message, "Готовлю выгрузку ваших вопросов и ответов...")
+        spool, filename = await export.export(user.id, fmt, compress)
+        with spool:
+            # The Bot API request is built from the whole file anyway, read it once
+            # so that retries of the upload send the same content
+            document = InputFile(spool.read(), filename=filename)
+        outbox.reply_document(update.message, document, write_timeout=export.UPLOAD_TIMEOUT)
+    except export.ExportTooLarge:
+        outbox.reply(update.message, "Выгрузка слишком большая для Telegram, даже в сжатом виде.")
+    except Exception as e:
+        logger.error("Ошибка при выгрузке для пользователя %s: %s", user.id, e)
+        outbox.reply(update.message, "Не удалось подготовить выгрузку. Пожалуйста, попробуйте позже.")
+    finally:
+        exporting_users.discard(user.id)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send help message."""
-    await update.message.reply_text(
+    outbox.reply(
+        update.message,
         "Для получения вашей персональной ссылки для анонимных вопросов используйте команду /getlink\n\n"
+        "Чтобы посмотреть, сколько вопросов вы получили и сколько ждут ответа, используйте команду /stats\n\n"
+        "Чтобы найти вопросы и ответы по словам, используйте команду /search <слова>\n\n"
+        "Чтобы выгрузить все полученные вопросы и ответы в файл, используйте команду /export [jsonl|csv] [gz]\n\n"
+        "Чтобы поделиться неотвеченным вопросом в любом чате, начните сообщение с имени бота через @ и выберите вопрос\n\n"
         "Чтобы отправить анонимный вопрос другому пользователю, перейдите по его персональной ссылке и напишите вопрос."
     )
 
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the user's question counters, and handler, database and Bot API latency metrics to admins."""
+    user_id = update.effective_user.id
+    counters = await async_database.get_user_counters(user_id)
+    if counters is None:
+        outbox.reply(update.message, "Произошла ошибка при получении статистики. Пожалуйста, попробуйте позже.")
+        return
+
+    text = (
+        f"Получено вопросов: {counters['received']}\n"
+        f"Неотвеченных: {counters['unanswered']}\n"
+        f"Отвечено: {counters['answered']}\n"
+        f"Задано вопросов: {counters['asked']}"
+    )
+    if user_id in ADMIN_IDS:
+        text += "\n\n" + metrics.summary()
+    outbox.reply(update.message, text)
+
+
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start sending a message to every user. Admins only, the text keeps its formatting."""
+    if update.effective_user.id not in ADMIN_IDS:
+        outbox.reply(update.message, "Команда доступна только администраторам.")
+        return
+
+    parts = update.message.text_html.split(maxsplit=1)
+    if len(parts) < 2:
+        outbox.reply(update.message, "Напишите текст рассылки после команды: /broadcast <текст>")
+        return
+
+    # Users still waiting in the write-behind cache wouldn't be among the recipients
+    await async_database.flush_users()
+    broadcast_id = await async_database.run(database.create_broadcast, parts[1], update.effective_user.id)
+    if broadcast_id is None:
+        outbox.reply(update.message, "Рассылка уже идет. Остановить ее можно командой /broadcast_stop")
+        return
+
+    context.job_queue.run_once(run_broadcast, when=0)
+    outbox.reply(update.message, f"Рассылка {broadcast_id} начата. Когда она закончится, я пришлю итоги.")
+
+
+async def stop_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel the running broadcast. It stops after the batch being sent."""
+    if update.effective_user.id not in ADMIN_IDS:
+        outbox.reply(update.message, "Команда доступна только администраторам.")
+        return
+
+    running = await async_database.read(database.get_broadcast)
+    if running is None or not await async_database.run(
+        database.finish_broadcast, running["broadcast_id"], database.BROADCAST_CANCELLED
+    ):
+        outbox.reply(update.message, "Сейчас нет активной рассылки.")
+        return
+    outbox.reply(update.message, f"Рассылка {running['broadcast_id']} остановлена.")
+
+
+async def run_broadcast(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the running broadcast, or resume it after a restart, and report the result to its author."""
+    await async_database.flush_users()
+    result = await broadcast.run()
+    if result is None or result["created_by"] is None:
+        return
+    status = "завершена" if result["status"] == database.BROADCAST_DONE else "остановлена"
+    outbox.send_message(
+        result["created_by"],
+        f"Рассылка {result['broadcast_id']} {status}.\n"
+        f"Отправлено: {result['sent']}\n"
+        f"Заблокировали бота: {result['blocked']}\n"
+        f"Ошибок: {result['failed']}"
+    )
+
+
+async def track_bot_blocked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mark users who block the bot, so broadcasts skip them, and unmark them when they unblock it."""
+    member = update.my_chat_member
+    if member.chat.type != "private":
+        return
+    status = member.new_chat_member.status
+    if status == ChatMember.BANNED:
+        await async_database.run(database.set_user_blocked, member.chat.id, True)
+    elif status == ChatMember.MEMBER:
+        await async_database.run(database.set_user_blocked, member.chat.id, False)
+
+
 async def answer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         query = update.callback_query
@@ -286,25 +710,29 @@ async def answer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         question_id = int(query.data.split('_')[1])
         
         # Get question details
-        question = database.get_question(question_id)
+        question = await async_database.get_question(question_id)
         if not question:
-            logger.error(f"Вопрос с ID {question_id} не найден в базе данных")
-            await query.message.reply_text("Вопрос не найден.")
+            logger.error("Вопрос с ID %s не найден в базе данных", question_id)
+            outbox.reply(query.message, "Вопрос не найден.")
             return ConversationHandler.END
         
-        # Set up conversation state
+        # Set up conversation state, remembering the digest to update after answering
         context.user_data['question_id'] = question_id
-        logger.info(f"Установлен question_id {question_id} для пользователя {query.from_user.id}")
+        context.user_data['digest_message'] = (query.message.chat_id, query.message.message_id)
+        logger.info("Установлен question_id %s для пользователя %s", question_id, query.from_user.id)
         
-        await query.message.reply_text(
+        outbox.reply(
+            query.message,
             "Введите ваш ответ на вопрос:\n\n"
-            f"{question[3]}"
+            f"{media.describe(question[10], question[5])}"
         )
+        if question[10]:
+            media.send(query.message.chat_id, question[10], question[11], priority=outbox.REPLY)
         
         return ASKING_ANSWER
     except Exception as e:
-        logger.error(f"Ошибка в answer_callback: {e}")
-        await query.message.reply_text("Произошла ошибка при обработке вопроса. Пожалуйста, попробуйте снова.")
+        logger.error("Ошибка в answer_callback: %s", e)
+        outbox.reply(query.message, "Произошла ошибка при обработке вопроса. Пожалуйста, попробуйте снова.")
         return ConversationHandler.END
 
 
@@ -313,107 +741,195 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         question_id = context.user_data.get('question_id')
         if not question_id:
             logger.error("question_id не найден в user_data")
-            await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте ответить на вопрос снова.")
+            outbox.reply(update.message, "Произошла ошибка. Пожалуйста, попробуйте ответить на вопрос снова.")
             return ConversationHandler.END
         
         # Get question details
-        question = database.get_question(question_id)
+        question = await async_database.get_question(question_id)
         if not question:
-            logger.error(f"Вопрос с ID {question_id} не найден в базе данных")
-            await update.message.reply_text("Вопрос не найден.")
+            logger.error("Вопрос с ID %s не найден в базе данных", question_id)
+            outbox.reply(update.message, "Вопрос не найден.")
             return ConversationHandler.END
         
         # Add answer to database
-        answer_id = database.add_answer(question_id, update.message.text)
+        answer_media = media.from_message(update.message)
+        answer_text = update.message.caption if answer_media else update.message.text
+        answer_id = await async_database.add_answer(question_id, answer_text, answer_media)
         if not answer_id:
-            logger.error(f"Не удалось сохранить ответ для вопроса {question_id}")
-            await update.message.reply_text("Не удалось сохранить ответ. Пожалуйста, попробуйте снова.")
+            logger.error("Не удалось сохранить ответ для вопроса %s", question_id)
+            outbox.reply(update.message, "Не удалось сохранить ответ. Пожалуйста, попробуйте снова.")
             return ConversationHandler.END
         
         # Notify question sender
-        try:
-            await context.bot.send_message(
-                chat_id=question[1],  # from_user_id
-                text="Ваш вопрос был ответлен!"
-            )
-            logger.info(f"Уведомление отправлено отправителю вопроса {question[1]}")
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление отправителю вопроса: {e}")
+        outbox.send_message(question[1], "Ваш вопрос был ответлен!")  # from_user_id
+        if answer_media:
+            # A media answer is passed on by file_id, without downloading it
+            media.send(question[1], answer_media[0], answer_media[1], caption=answer_text)
         
-        await update.message.reply_text("Ответ сохранен и отправитель уведомлен!")
+        outbox.reply(update.message, "Ответ сохранен и отправитель уведомлен!")
         context.user_data.pop('question_id', None)
-        logger.info(f"Ответ сохранен для вопроса {question_id}")
+        logger.info("Ответ сохранен для вопроса %s", question_id)
+
+        # Update the digest the question was picked from
+        await refresh_digest(update.effective_user.id, context.user_data)
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Ошибка в handle_answer: {e}")
-        await update.message.reply_text("Произошла ошибка при обработке ответа. Пожалуйста, попробуйте снова.")
+        logger.error("Ошибка в handle_answer: %s", e)
+        outbox.reply(update.message, "Произошла ошибка при обработке ответа. Пожалуйста, попробуйте снова.")
         return ConversationHandler.END
 
 
+def build_application(bot: Bot = None, persistence: bool = True) -> Application:
+    """
+    Create the application and register all handlers. A ready-made bot can be passed instead of the token.
+    Without persistence, conversations and user_data are kept in memory only, e.g. for benchmarks.
+    """
+    builder = (
+        Application.builder()
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    if persistence:
+        builder = builder.persistence(SQLitePersistence())
+    if bot is not None:
+        builder = builder.bot(bot)
+    else:
+        builder = builder.token(TOKEN)
+    if MAX_CONCURRENT_UPDATES > 1:
+        # Users are served in parallel, each user's updates still in order
+        processor = update_processor.UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES)
+        builder = builder.concurrent_updates(processor).update_queue(
+            update_processor.UpdateQueue(processor, update_processor.UPDATE_QUEUE_SIZE)
+        )
+    application = builder.build()
+
+    # Add conversation handler with the states ASKING_QUESTION and ASKING_ANSWER
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            ASKING_QUESTION: [
+                MessageHandler((filters.TEXT & ~filters.COMMAND) | media.FILTER, handle_question)
+            ],
+            ASKING_ANSWER: [
+                MessageHandler((filters.TEXT & ~filters.COMMAND) | media.FILTER, handle_answer)
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="conversation",
+        persistent=persistence,
+    )
+
+    application.add_handler(conv_handler)
+    
+    # Add answer command handler
+    application.add_handler(CommandHandler("answer", answer_question))
+    
+    # Add callback query handler for answer button
+    application.add_handler(CallbackQueryHandler(answer_callback, pattern="^answer_"))
+
+    # Add callback query handler for inbox page navigation
+    application.add_handler(CallbackQueryHandler(questions_page, pattern=r"^page\|"))
+
+    # Add handler for search result pages
+    application.add_handler(CallbackQueryHandler(search_page, pattern=r"^search\|"))
+    
+    # Add message handler for answers, commands are left to their own handlers
+    application.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | media.FILTER, handle_answer))
+    
+    # Add command handlers
+    application.add_handler(CommandHandler("getlink", getlink))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("questions", view_questions))
+    application.add_handler(CommandHandler("search", search))
+    # Exports can take a while, so they run without holding up other updates
+    application.add_handler(CommandHandler("export", export_history, block=False))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("broadcast", start_broadcast))
+    application.add_handler(CommandHandler("broadcast_stop", stop_broadcast))
+
+    # Browse and share unanswered questions in inline mode
+    application.add_handler(InlineQueryHandler(inline_inbox))
+
+    # Track users blocking and unblocking the bot
+    application.add_handler(ChatMemberHandler(track_bot_blocked, ChatMemberHandler.MY_CHAT_MEMBER))
+    
+    # Set up error handler
+    async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        logger.error("Ошибка при обработке обновления: %s", context.error)
+        if update:
+            outbox.reply(
+                update.message,
+                "Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте снова."
+            )
+
+    application.add_error_handler(error_handler)
+
+    # Record latency and errors of every handler
+    for handlers in application.handlers.values():
+        metrics.instrument_handlers(handlers)
+
+    # Write cached user changes behind in batches
+    application.job_queue.run_repeating(flush_users, interval=user_cache.USER_FLUSH_INTERVAL)
+
+    # Fill new tables and build indexes left over by migrations
+    application.job_queue.run_once(run_backfills, when=0)
+
+    # Resume a broadcast interrupted by a restart
+    application.job_queue.run_once(run_broadcast, when=0)
+
+    # Archive old questions in small batches
+    if ANSWERED_RETENTION_DAYS or UNANSWERED_RETENTION_DAYS or ARCHIVE_RETENTION_DAYS:
+        application.job_queue.run_repeating(archive_questions, interval=retention.RETENTION_INTERVAL)
+
+    return application
+
+
+def run_webhook(application: Application) -> None:
+    """Serve updates over a webhook, e.g. behind a reverse proxy."""
+    if not WEBHOOK_URL:
+        raise ValueError("Не найден WEBHOOK_URL в .env файле. Он нужен для режима webhook.")
+
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+
 def main() -> None:
     """Start the bot."""
     try:
         # Initialize database
+        database.set_database_file(database.DATABASE_FILE, SHARD_COUNT)
         database.init_db()
         logger.info("База данных инициализирована")
 
         # Create application
-        application = Application.builder().token(TOKEN).build()
+        application = build_application()
         logger.info("Приложение создано")
 
-        # States for conversation
-        ASKING_QUESTION = 1
-        ASKING_ANSWER = 2
-
-        # Add conversation handler with the states ASKING_QUESTION and ASKING_ANSWER
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start)],
-            states={
-                ASKING_QUESTION: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_question)
-                ],
-                ASKING_ANSWER: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_answer)
-                ]
-            },
-            fallbacks=[CommandHandler("cancel", cancel)],
-        )
-
-        application.add_handler(conv_handler)
-        
-        # Add answer command handler
-        application.add_handler(CommandHandler("answer", answer_question))
-        
-        # Add callback query handler for answer button
-        application.add_handler(CallbackQueryHandler(answer_callback, pattern="^answer_"))
-        
-        # Add message handler for answers
-        application.add_handler(MessageHandler(filters.TEXT, handle_answer))
-        
-        # Add command handlers
-        application.add_handler(CommandHandler("getlink", getlink))
-        application.add_handler(CommandHandler("help", help_command))
-        
-        # Set up error handler
-        async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-            logger.error(f"Ошибка при обработке обновления: {context.error}")
-            if update:
-                await update.message.reply_text(
-                    "Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте снова."
-                )
-
-        application.add_error_handler(error_handler)
-        logger.info("Обработчик ошибок установлен")
-
         # Start the bot
         print("Бот запущен в режиме сервиса...")
-        logger.info("Запуск бота...")
-        application.run_polling()
+        logger.info("Запуск бота в режиме %s...", BOT_MODE)
+        if BOT_MODE == "webhook":
+            run_webhook(application)
+        else:
+            application.run_polling()
     except Exception as e:
-        logger.error(f"Критическая ошибка при запуске бота: {e}")
+        logger.error("Критическая ошибка при запуске бота: %s", e)
         print(f"Ошибка при запуске бота: {e}")
         raise
+    finally:
+        # Stop the export threads and the DB worker, then close pooled database connections
+        export.shutdown()
+        async_database.shutdown()
+        database.close_connections()
+        # Write out the log records still queued
+        logging_setup.stop_logging()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
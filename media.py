@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram.ext import filters
+
+import outbox
+
+# Media accepted as questions and answers: type -> (Bot API method, file argument)
+MEDIA_TYPES = {
+    "voice": ("send_voice", "voice"),
+    "photo": ("send_photo", "photo"),
+    "video_note": ("send_video_note", "video_note"),
+    "sticker": ("send_sticker", "sticker"),
+}
+# Types whose messages can have a caption
+CAPTIONED = {"voice", "photo"}
+
+LABELS = {
+    "voice": "🎤 Голосовое сообщение",
+    "photo": "🖼 Фото",
+    "video_note": "📹 Видеосообщение",
+    "sticker": "🙂 Стикер",
+}
+
+FILTER = filters.VOICE | filters.PHOTO | filters.VIDEO_NOTE | filters.Sticker.ALL
+
+
+def from_message(message) -> tuple:
+    """
+    (media_type, file_id, file_unique_id) of the media in a message, or None for other messages.
+    Only Telegram's references are kept, the file itself is never downloaded.
+    """
+    for media_type in MEDIA_TYPES:
+        attachment = getattr(message, media_type)
+        if not attachment:
+            continue
+        if media_type == "photo":
+            # Photos come in several sizes, the last one is the largest
+            attachment = attachment[-1]
+        return media_type, attachment.file_id, attachment.file_unique_id
+    return None
+
+
+def describe(media_type: str, text: str) -> str:
+    """Text shown for a question or an answer in lists and notifications: the media label and the caption."""
+    if not media_type:
+        return text or ""
+    label = LABELS.get(media_type, media_type)
+    return f"{label}\n{text}" if text else label
+
+
+def send(chat_id: int, media_type: str, file_id: str, caption: str = None,
+         priority: int = outbox.NOTIFICATION, **kwargs) -> asyncio.Future:
+    """Queue media to a chat by its file_id, so Telegram sends the stored file without an upload."""
+    method, argument = MEDIA_TYPES[media_type]
+    if caption and media_type in CAPTIONED:
+        kwargs["caption"] = caption
+    return outbox.scheduler.send(method, chat_id, priority, **{argument: file_id}, **kwargs)
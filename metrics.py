@@ -0,0 +1,220 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# What each kind of measured call is, used in the Prometheus HELP lines
+KINDS = {
+    "handler": "Telegram update handler latency",
+    "db": "Database function latency",
+    "telegram": "Bot API call latency",
+}
+
+# Section titles in the /stats summary
+SUMMARY_TITLES = {
+    "handler": "Обработчики",
+    "db": "База данных",
+    "telegram": "Bot API",
+}
+
+
+class Histogram:
+    """Latency histogram with fixed BUCKETS, plus call and error counts."""
+
+    __slots__ = ("buckets", "total", "count", "errors")
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.total += seconds
+        self.count += 1
+        if error:
+            self.errors += 1
+
+    def quantile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given quantile, inf if it is above all buckets."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+_lock = threading.Lock()
+_histograms = defaultdict(dict)
+_gauges = {}
+
+
+def observe(kind: str, name: str, seconds: float, error: bool = False):
+    """Record one call of `name` of the given kind. Safe to call from any thread."""
+    with _lock:
+        histogram = _histograms[kind].get(name)
+        if histogram is None:
+            histogram = _histograms[kind][name] = Histogram()
+        histogram.observe(seconds, error)
+
+
+def gauge(name: str, read):
+    """Register a gauge whose value is read by calling read() when metrics are collected."""
+    _gauges[name] = read
+
+
+def timed(kind: str):
+    """Decorator recording latency and errors of a sync or async function under its name."""
+    def decorator(func):
+        name = func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                error = False
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    observe(kind, name, time.perf_counter() - started, error)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = False
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                observe(kind, name, time.perf_counter() - started, error)
+        return wrapper
+
+    return decorator
+
+
+def instrument_handlers(handlers: list):
+    """Wrap the callbacks of handlers, including the ones nested in ConversationHandlers, with timed("handler")."""
+    from telegram.ext import ConversationHandler
+
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        elif not getattr(handler.callback, "_instrumented", False):
+            handler.callback = timed("handler")(handler.callback)
+            handler.callback._instrumented = True
+
+
+def _snapshot() -> tuple:
+    with _lock:
+        histograms = {
+            kind: {name: (list(h.buckets), h.total, h.count, h.errors) for name, h in names.items()}
+            for kind, names in _histograms.items()
+        }
+    gauges = {}
+    for name, read in _gauges.items():
+        try:
+            gauges[name] = read()
+        except Exception as e:
+            logger.error("Ошибка при чтении метрики %s: %s", name, e)
+    return histograms, gauges
+
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    histograms, gauges = _snapshot()
+    lines = []
+    for kind, names in sorted(histograms.items()):
+        metric = f"aqbot_{kind}_seconds"
+        lines.append(f"# HELP {metric} {KINDS.get(kind, kind)}")
+        lines.append(f"# TYPE {metric} histogram")
+        for name, (buckets, total, count, _) in sorted(names.items()):
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{name="{name}",le="+Inf"}} {count}')
+            lines.append(f'{metric}_sum{{name="{name}"}} {total}')
+            lines.append(f'{metric}_count{{name="{name}"}} {count}')
+
+        errors = f"aqbot_{kind}_errors_total"
+        lines.append(f"# TYPE {errors} counter")
+        for name, (_, _, _, error_count) in sorted(names.items()):
+            lines.append(f'{errors}{{name="{name}"}} {error_count}')
+
+    for name, value in sorted(gauges.items()):
+        lines.append(f"# TYPE aqbot_{name} gauge")
+        lines.append(f"aqbot_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """Short human-readable summary for the admin /stats command."""
+    histograms, gauges = _snapshot()
+    lines = []
+    for kind, names in sorted(histograms.items()):
+        lines.append(f"{SUMMARY_TITLES.get(kind, kind)}:")
+        for name, (buckets, total, count, errors) in sorted(names.items(), key=lambda item: -item[1][1]):
+            histogram = Histogram()
+            histogram.buckets, histogram.count = buckets, count
+            lines.append(
+                f"  {name}: {count} вызовов, {errors} ошибок, "
+                f"среднее {total / count * 1000:.1f} мс, p95 ≤ {histogram.quantile(0.95) * 1000:.0f} мс"
+            )
+    if gauges:
+        lines.append("Очереди:")
+        lines.extend(f"  {name}: {value}" for name, value in sorted(gauges.items()))
+    return "\n".join(lines) or "Метрик пока нет."
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_prometheus().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error("Ошибка при отдаче метрик: %s", e)
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.AbstractServer:
+    """Serve GET /metrics on host:port."""
+    server = await asyncio.start_server(_serve, host, port)
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return server
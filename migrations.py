@@ -0,0 +1,478 @@
+import argparse
+import logging
+import sqlite3
+import time
+
+import async_database
+import database
+import logging_setup
+
+logger = logging.getLogger(__name__)
+
+# Rows handled per backfill transaction
+BACKFILL_CHUNK_SIZE = 2000
+
+
+class Migration:
+    """
+    One schema version. apply(cursor) makes the quick schema changes and runs at startup,
+    in the same transaction that sets PRAGMA user_version to `version`.
+    backfill(cursor, position), if given, does the slow part afterwards, such as filling a
+    new table or building an index on a large one. It is called once per chunk, each in its
+    own transaction, with the position it returned last time (None at first), and returns
+    None when it is done. Progress is kept in schema_backfills, so it resumes after a restart.
+    """
+
+    def __init__(self, version: int, description: str, apply=None, backfill=None):
+        self.version = version
+        self.description = description
+        self.apply = apply
+        self.backfill = backfill
+
+
+def _create_base_tables(cursor: sqlite3.Cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS questions (
+            question_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user_id INTEGER,
+            to_user_id INTEGER,
+            question_text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_answered BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (from_user_id) REFERENCES users (user_id),
+            FOREIGN KEY (to_user_id) REFERENCES users (user_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answers (
+            answer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            question_id INTEGER,
+            answer_text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (question_id) REFERENCES questions (question_id)
+        )
+    ''')
+    # Conversation persistence
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS persistence_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS persistence_conversations (
+            name TEXT,
+            key TEXT,
+            state INTEGER,
+            PRIMARY KEY (name, key)
+        )
+    ''')
+
+
+def _build_index(name: str, definition: str):
+    """Backfill building an index. SQLite builds an index in one statement, so it is a single chunk."""
+    def backfill(cursor: sqlite3.Cursor, position):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+        return None
+    return backfill
+
+
+# Answer texts of a question as one string, for the search index
+ANSWER_TEXTS_SQL = "(SELECT group_concat(answer_text, ' ') FROM answers WHERE question_id = {})"
+
+
+def _create_search_index(cursor: sqlite3.Cursor):
+    """
+    FTS5 index over question and answer texts, one row per question with
+    rowid = question_id, kept in sync by triggers. owner holds "u<to_user_id>",
+    so that searches are scoped to one inbox inside the full-text query itself.
+    """
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+            owner, question_text, answer_text,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS questions_fts_insert AFTER INSERT ON questions BEGIN
+            INSERT INTO questions_fts (rowid, owner, question_text, answer_text)
+            VALUES (new.question_id, 'u' || new.to_user_id, new.question_text, '');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS questions_fts_update AFTER UPDATE OF to_user_id, question_text ON questions BEGIN
+            UPDATE questions_fts SET owner = 'u' || new.to_user_id, question_text = new.question_text
+            WHERE rowid = new.question_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS questions_fts_delete AFTER DELETE ON questions BEGIN
+            DELETE FROM questions_fts WHERE rowid = old.question_id;
+        END
+    ''')
+    for event, row in (("INSERT", "new"), ("UPDATE OF answer_text", "new"), ("DELETE", "old")):
+        name = event.split()[0].lower()
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS answers_fts_{name} AFTER {event} ON answers BEGIN
+                UPDATE questions_fts SET answer_text = coalesce({ANSWER_TEXTS_SQL.format(row + '.question_id')}, '')
+                WHERE rowid = {row}.question_id;
+            END
+        ''')
+
+
+def _backfill_search_index(cursor: sqlite3.Cursor, position):
+    """Index questions created before the triggers, by question_id range. Rows the triggers already indexed are skipped."""
+    start = position or 0
+    end = start + BACKFILL_CHUNK_SIZE
+    cursor.execute(f'''
+        INSERT INTO questions_fts (rowid, owner, question_text, answer_text)
+        SELECT q.question_id, 'u' || q.to_user_id, q.question_text,
+               coalesce({ANSWER_TEXTS_SQL.format('q.question_id')}, '')
+        FROM questions q
+        WHERE q.question_id > ? AND q.question_id <= ?
+          AND q.question_id NOT IN (SELECT rowid FROM questions_fts WHERE rowid > ? AND rowid <= ?)
+    ''', (start, end, start, end))
+    if cursor.execute("SELECT 1 FROM questions WHERE question_id > ? LIMIT 1", (end,)).fetchone():
+        return end
+    return None
+
+
+def _create_counters(cursor: sqlite3.Cursor):
+    """Per-user question counters, kept up to date by the question and answer writers."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_counters (
+            user_id INTEGER PRIMARY KEY,
+            received INTEGER NOT NULL DEFAULT 0,
+            unanswered INTEGER NOT NULL DEFAULT 0,
+            answered INTEGER NOT NULL DEFAULT 0,
+            asked INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+
+def _backfill_inbox_counters(cursor: sqlite3.Cursor, position):
+    """
+    Recount received, unanswered and answered for the next chunk of recipients, by to_user_id.
+    Counts are replaced, not added to, so writes made before the chunk are not counted twice.
+    """
+    start = position if position is not None else -2 ** 63
+    row = cursor.execute('''
+        SELECT max(to_user_id) FROM (
+            SELECT DISTINCT to_user_id FROM questions WHERE to_user_id > ? ORDER BY to_user_id LIMIT ?
+        )
+    ''', (start, BACKFILL_CHUNK_SIZE)).fetchone()
+    if row[0] is None:
+        return None
+    end = row[0]
+    cursor.execute('''
+        INSERT INTO user_counters (user_id, received, unanswered, answered)
+        SELECT to_user_id, count(*), sum(NOT is_answered), sum(is_answered)
+        FROM questions WHERE to_user_id > ? AND to_user_id <= ?
+        GROUP BY to_user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            received = excluded.received, unanswered = excluded.unanswered, answered = excluded.answered
+    ''', (start, end))
+    return end
+
+
+def _backfill_asked_counters(cursor: sqlite3.Cursor, position):
+    """
+    Recount asked for every sender, by question_id range. There is no index by sender, so
+    counts are added chunk by chunk instead of replaced. The first chunk resets asked, which
+    only senders since the migration have, and notes the last id of every id bucket, so that
+    questions added since then, already counted when they were added, are skipped.
+    """
+    if position is None:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS asked_backfill_snapshot (
+                bucket INTEGER PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("DELETE FROM asked_backfill_snapshot")
+        # Ids from before sharding, and from buckets first used later, which start past these
+        cursor.execute("INSERT INTO asked_backfill_snapshot SELECT -1, coalesce(max(question_id), 0) FROM questions")
+        if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'bucket_sequences'").fetchone():
+            cursor.execute(
+                "INSERT INTO asked_backfill_snapshot SELECT bucket, last_seq * ? + bucket FROM bucket_sequences",
+                (database.NUM_BUCKETS,),
+            )
+        cursor.execute("UPDATE user_counters SET asked = 0 WHERE asked != 0")
+        position = 0
+
+    row = cursor.execute('''
+        SELECT max(question_id) FROM (
+            SELECT question_id FROM questions
+            WHERE question_id > ? AND question_id <= (SELECT max(last_id) FROM asked_backfill_snapshot)
+            ORDER BY question_id LIMIT ?
+        )
+    ''', (position, BACKFILL_CHUNK_SIZE)).fetchone()
+    if row[0] is None:
+        cursor.execute("DROP TABLE asked_backfill_snapshot")
+        return None
+    end = row[0]
+    cursor.execute('''
+        INSERT INTO user_counters (user_id, asked)
+        SELECT from_user_id, count(*) FROM questions q
+        WHERE question_id > ? AND question_id <= ? AND from_user_id IS NOT NULL
+          AND question_id <= coalesce(
+              (SELECT last_id FROM asked_backfill_snapshot WHERE bucket = q.question_id % ?),
+              (SELECT last_id FROM asked_backfill_snapshot WHERE bucket = -1)
+          )
+        GROUP BY from_user_id
+        ON CONFLICT (user_id) DO UPDATE SET asked = asked + excluded.asked
+    ''', (position, end, database.NUM_BUCKETS))
+    return end
+
+
+def _create_broadcasts(cursor: sqlite3.Cursor):
+    """Broadcasts with their progress, and a mark on users who blocked the bot."""
+    cursor.execute("ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT NOT NULL DEFAULT 'running',
+            position INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+
+def _create_media(cursor: sqlite3.Cursor):
+    """
+    Telegram file references of media questions and answers, one row per file.
+    file_unique_id is the same for a file everywhere, file_id is what the bot sends it by.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media (
+            file_unique_id TEXT PRIMARY KEY,
+            media_type TEXT NOT NULL,
+            file_id TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("ALTER TABLE questions ADD COLUMN file_unique_id TEXT REFERENCES media (file_unique_id)")
+    cursor.execute("ALTER TABLE answers ADD COLUMN file_unique_id TEXT REFERENCES media (file_unique_id)")
+
+
+def _create_sharding(cursor: sqlite3.Cursor):
+    """
+    Per-bucket id sequences, see database._next_id, and the number of shards the data is
+    laid out for, which is only kept in shard 0 and changed by python -m sharding.
+    rebalance_to is set while a rebalance is unfinished.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bucket_sequences (
+            bucket INTEGER PRIMARY KEY,
+            last_seq INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_layout (
+            shard_count INTEGER NOT NULL,
+            rebalance_to INTEGER
+        )
+    ''')
+
+
+# Ordered schema history. Released migrations must not change, add new ones at the end.
+MIGRATIONS = [
+    Migration(1, "Таблицы пользователей, вопросов, ответов и состояния диалогов", apply=_create_base_tables),
+    Migration(2, "Индекс входящих вопросов", backfill=_build_index(
+        "idx_questions_inbox", "questions (to_user_id, is_answered, created_at, question_id)"
+    )),
+    Migration(3, "Индекс ответов по вопросу", backfill=_build_index("idx_answers_question", "answers (question_id)")),
+    Migration(4, "Полнотекстовый поиск по вопросам и ответам",
+              apply=_create_search_index, backfill=_backfill_search_index),
+    Migration(5, "Индекс для архивации", backfill=_build_index(
+        "idx_questions_retention", "questions (is_answered, created_at)"
+    )),
+    Migration(6, "Счётчики входящих вопросов", apply=_create_counters, backfill=_backfill_inbox_counters),
+    Migration(7, "Счётчики заданных вопросов", backfill=_backfill_asked_counters),
+    Migration(8, "Рассылки и отметка заблокировавших бота", apply=_create_broadcasts),
+    Migration(9, "Медиа в вопросах и ответах", apply=_create_media),
+    Migration(10, "Шардирование вопросов по получателю", apply=_create_sharding),
+]
+
+_BY_VERSION = {migration.version: migration for migration in MIGRATIONS}
+
+
+class _DryRun(Exception):
+    """Raised to roll back a dry run."""
+
+
+def current_version(shard: int = 0) -> int:
+    return database.get_connection(shard).execute("PRAGMA user_version").fetchone()[0]
+
+
+def pending(shard: int = 0) -> list:
+    """Migrations not applied to a shard yet."""
+    version = current_version(shard)
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def _create_backfills_table(shard: int = 0):
+    with database.transaction(shard=shard) as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_backfills (
+                version INTEGER PRIMARY KEY,
+                position INTEGER,
+                done BOOLEAN NOT NULL DEFAULT FALSE
+            )
+        ''')
+
+
+def _apply(migration: Migration, shard: int = 0) -> float:
+    started = time.perf_counter()
+    with database.transaction(shard=shard) as cursor:
+        if migration.apply is not None:
+            migration.apply(cursor)
+        if migration.backfill is not None:
+            cursor.execute("INSERT OR IGNORE INTO schema_backfills (version) VALUES (?)", (migration.version,))
+        cursor.execute(f"PRAGMA user_version = {int(migration.version)}")
+    return time.perf_counter() - started
+
+
+def backfill_chunk(shard: int = 0):
+    """
+    Run one chunk of the oldest unfinished backfill on a shard.
+    Returns (version, done), or None if no backfill is left or it failed.
+    """
+    try:
+        with database.transaction(shard=shard) as cursor:
+            row = cursor.execute(
+                "SELECT version, position FROM schema_backfills WHERE NOT done ORDER BY version LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            version, position = row
+            position = _BY_VERSION[version].backfill(cursor, position)
+            cursor.execute(
+                "UPDATE schema_backfills SET position = ?, done = ? WHERE version = ?",
+                (position, position is None, version),
+            )
+        return version, position is None
+    except sqlite3.Error as e:
+        logger.error("Ошибка фоновой миграции: %s", e)
+        return None
+
+
+def _run_backfills_now(report: list, shard: int = 0):
+    """Run every pending backfill of a shard to the end on this thread, adding (version, description, seconds) to report."""
+    started = {}
+    while True:
+        chunk_started = time.perf_counter()
+        result = backfill_chunk(shard)
+        if result is None:
+            return
+        version, done = result
+        started.setdefault(version, chunk_started)
+        if done:
+            report.append((version, _BY_VERSION[version].description + " (заполнение)", time.perf_counter() - started[version]))
+
+
+def migrate(dry_run: bool = False, shard: int = 0) -> list:
+    """
+    Apply pending migrations to a shard in order, each in its own transaction. On an empty database the
+    backfills run right away, otherwise they are left to run_backfills() after startup.
+    A dry run applies everything, including the first chunk of every backfill, and rolls it
+    back. Returns [(version, description, seconds)] for every step.
+    """
+    report = []
+    if dry_run:
+        try:
+            # Nested transactions join this one, so everything is rolled back together
+            with database.transaction(shard=shard):
+                _create_backfills_table(shard)
+                for migration in pending(shard):
+                    report.append((migration.version, migration.description, _apply(migration, shard)))
+                    if migration.backfill is not None:
+                        started = time.perf_counter()
+                        backfill_chunk(shard)
+                        report.append((migration.version, migration.description + " (первая порция)",
+                                       time.perf_counter() - started))
+                raise _DryRun()
+        except _DryRun:
+            return report
+
+    _create_backfills_table(shard)
+    for migration in pending(shard):
+        seconds = _apply(migration, shard)
+        report.append((migration.version, migration.description, seconds))
+        logger.info("Миграция %s применена к шарду %s за %.2f с: %s",
+                    migration.version, shard, seconds, migration.description)
+
+    if not database.get_connection(shard).execute("SELECT 1 FROM questions LIMIT 1").fetchone():
+        _run_backfills_now(report, shard)
+    return report
+
+
+async def run_backfills():
+    """
+    Finish pending backfills in the background, shard by shard, one chunk per DB worker call,
+    so live queries get in between.
+    """
+    for shard in range(database.shard_count()):
+        started = {}
+        while True:
+            chunk_started = time.perf_counter()
+            result = await async_database.run_on(shard, backfill_chunk, shard)
+            if result is None:
+                break
+            version, done = result
+            started.setdefault(version, chunk_started)
+            if done:
+                logger.info("Фоновая миграция %s на шарде %s завершена за %.1f с: %s", version, shard,
+                            time.perf_counter() - started[version], _BY_VERSION[version].description)
+
+
+def _print_report(report: list):
+    print(f"{'version':<9}{'seconds':>10}  step")
+    for version, description, seconds in report:
+        print(f"{version:<9}{seconds:>10.3f}  {description}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply database migrations and report how long every step takes.")
+    parser.add_argument("--database", default=database.DATABASE_FILE)
+    parser.add_argument("--shards", type=int, default=1, help="number of shard files the database is split into")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="apply pending steps and the first chunk of every backfill, then roll back")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="switch an existing database to incremental auto-vacuum, rewrites the whole file")
+    args = parser.parse_args()
+
+    logging_setup.setup_logging()
+    database.set_database_file(args.database, args.shards)
+    try:
+        for shard, database_file in enumerate(database.shard_files(args.database, args.shards)):
+            print(f"{database_file}: schema version {current_version(shard)}, latest: {MIGRATIONS[-1].version}")
+            if args.vacuum:
+                started = time.perf_counter()
+                database.enable_incremental_vacuum(convert_existing=True, shard=shard)
+                print(f"Incremental auto-vacuum enabled in {time.perf_counter() - started:.1f} s")
+
+            report = migrate(dry_run=args.dry_run, shard=shard)
+            if not args.dry_run:
+                _run_backfills_now(report, shard)
+            _print_report(report)
+        if args.dry_run:
+            print("Dry run, nothing was changed.")
+    finally:
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    main()
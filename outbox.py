@@ -0,0 +1,266 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram limits: about 30 messages per second overall and 1 per second per chat
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0  # seconds, doubled on every network error
+MAX_CONCURRENT_SENDS = 16
+MAX_CHAT_BUCKETS = 10000
+DRAIN_TIMEOUT = 10  # seconds
+
+# Priority lanes, lower values are sent first
+REPLY = 0
+NOTIFICATION = 1
+BROADCAST = 2
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens."""
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self.blocked_until = 0.0
+
+    def _refill(self) -> float:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def delay(self) -> float:
+        """Seconds until a token can be taken, 0 if one is available now."""
+        now = self._refill()
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        """Take one token."""
+        self._refill()
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Refuse tokens for the given number of seconds, e.g. after a 429 from Telegram."""
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+    def is_idle(self) -> bool:
+        """Whether the bucket is full and unblocked, so it can be dropped and recreated later."""
+        return self.delay() == 0 and self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("method", "chat_id", "kwargs", "future", "attempts")
+
+    def __init__(self, method: str, chat_id: int, kwargs: dict, future: asyncio.Future):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class OutboundScheduler:
+    """
+    Central queue for outgoing Bot API calls.
+    Jobs are sent in priority order under a global and a per-chat token bucket.
+    429 responses are retried after Telegram's retry_after, network errors with backoff.
+    send() returns a future, so callers never wait for delivery unless they want to.
+    """
+
+    def __init__(self, bot=None, global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST,
+                 max_retries: int = MAX_RETRIES, max_concurrent: int = MAX_CONCURRENT_SENDS):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_concurrent = max_concurrent
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._seq = itertools.count()
+        self._queue = None
+        self._semaphore = None
+        self._dispatcher = None
+        self._tasks = set()
+        self._parked = 0
+
+    def start(self, bot=None):
+        """Start the dispatcher on the running event loop."""
+        if bot is not None:
+            self.bot = bot
+        if self._dispatcher is None:
+            self._queue = asyncio.PriorityQueue()
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT):
+        """Wait for queued jobs to be delivered, up to timeout seconds, then stop the dispatcher."""
+        if self._dispatcher is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.pending() and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.pending():
+            logger.warning("Не отправлено сообщений при остановке: %s", self.pending())
+
+        self._dispatcher.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(self._dispatcher, *self._tasks, return_exceptions=True)
+        self._dispatcher = None
+        self._queue = None
+
+    def pending(self) -> int:
+        """Number of jobs queued, waiting for a retry or being sent."""
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() + self._parked + len(self._tasks)
+
+    def send(self, method: str, chat_id: int, priority: int = NOTIFICATION, log_errors: bool = True,
+             **kwargs) -> asyncio.Future:
+        """
+        Queue a Bot API call such as "send_message" and return a future with its result.
+        Failures are logged unless log_errors is False, for callers that handle them themselves.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        if log_errors:
+            future.add_done_callback(_log_failure)
+        self._queue.put_nowait((priority, next(self._seq), _Job(method, chat_id, kwargs, future)))
+        return future
+
+    async def _dispatch(self):
+        while True:
+            priority, seq, job = await self._queue.get()
+            if job.future.done():
+                continue
+
+            # A throttled chat must not hold up other chats, so park its job instead of waiting
+            chat = self._chat_bucket(job.chat_id)
+            delay = chat.delay()
+            if delay > 0:
+                self._park(delay, priority, seq, job)
+                continue
+
+            delay = self._global.delay()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self._global.delay()
+
+            chat.consume()
+            self._global.consume()
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._deliver(priority, seq, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, priority: int, seq: int, job: _Job):
+        try:
+            result = await self._call(job)
+            if not job.future.done():
+                job.future.set_result(result)
+        except RetryAfter as e:
+            retry_after = _seconds(e.retry_after)
+            logger.warning("Превышен лимит Telegram для чата %s, повтор через %s с", job.chat_id, retry_after)
+            self._chat_bucket(job.chat_id).block(retry_after)
+            self._retry(retry_after, priority, seq, job, e)
+        except (BadRequest, Forbidden) as e:
+            job.future.set_exception(e)
+        except NetworkError as e:
+            self._retry(RETRY_BACKOFF * 2 ** job.attempts, priority, seq, job, e)
+        except Exception as e:
+            job.future.set_exception(e)
+        finally:
+            self._semaphore.release()
+
+    async def _call(self, job: _Job):
+        """Make the Bot API call and record its latency."""
+        started = time.perf_counter()
+        error = False
+        try:
+            return await getattr(self.bot, job.method)(chat_id=job.chat_id, **job.kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.observe("telegram", job.method, time.perf_counter() - started, error)
+
+    def _retry(self, delay: float, priority: int, seq: int, job: _Job, error: Exception):
+        job.attempts += 1
+        if job.attempts > self.max_retries:
+            job.future.set_exception(error)
+        else:
+            self._park(delay, priority, seq, job)
+
+    def _park(self, delay: float, priority: int, seq: int, job: _Job):
+        """Put a job back into the queue after delay seconds, keeping its place in line."""
+        self._parked += 1
+
+        def requeue():
+            self._parked -= 1
+            if self._queue is not None:
+                self._queue.put_nowait((priority, seq, job))
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+
+def _seconds(value) -> float:
+    """Convert retry_after, an int or a timedelta depending on the library version, to seconds."""
+    if hasattr(value, "total_seconds"):
+        return value.total_seconds()
+    return float(value)
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Не удалось отправить сообщение: %s", future.exception())
+
+
+scheduler = OutboundScheduler()
+
+
+def send_message(chat_id: int, text: str, priority: int = NOTIFICATION, **kwargs) -> asyncio.Future:
+    """Queue a message to a chat. Notifications go behind direct replies."""
+    return scheduler.send("send_message", chat_id, priority, text=text, **kwargs)
+
+
+def reply(message, text: str, **kwargs) -> asyncio.Future:
+    """Queue a reply in the chat of the given message, ahead of notifications."""
+    return scheduler.send("send_message", message.chat_id, REPLY, text=text, **kwargs)
+
+
+def edit_message_text(chat_id: int, message_id: int, text: str, **kwargs) -> asyncio.Future:
+    """Queue an in-place edit of a message, with the same priority as a direct reply."""
+    return scheduler.send("edit_message_text", chat_id, REPLY, message_id=message_id, text=text, **kwargs)
+
+
+def reply_document(message, document, **kwargs) -> asyncio.Future:
+    """Queue a document upload in the chat of the given message, with the priority of a direct reply."""
+    return scheduler.send("send_document", message.chat_id, REPLY, document=document, **kwargs)
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_database
+import database
+
+logger = logging.getLogger(__name__)
+
+# How often the application hands changed user_data and conversation states to the persistence
+PERSISTENCE_INTERVAL = 5  # seconds
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Keeps user_data and ConversationHandler states in the bot database.
+    Only users and conversation keys that changed are written, and all changes
+    handed over by one persistence run are committed in a single transaction
+    on the DB worker thread. Chat, bot and callback data are not stored.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._pending_user_data = {}
+        self._pending_conversations = {}
+        self._commit_task = None
+
+    async def get_user_data(self) -> dict:
+        rows = await async_database.read(database.load_user_data)
+        return {user_id: json.loads(data) for user_id, data in rows.items()}
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await async_database.read(database.load_conversations, name)
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending_user_data[user_id] = json.dumps(data)
+        self._schedule_commit()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_user_data[user_id] = None
+        self._schedule_commit()
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self._pending_conversations[(name, json.dumps(key))] = new_state
+        self._schedule_commit()
+
+    async def flush(self) -> None:
+        """Write whatever is still pending, called when the application shuts down."""
+        if self._commit_task is not None:
+            await self._commit_task
+        await self._commit()
+
+    def _schedule_commit(self):
+        # All update_* calls of one persistence run land here before the commit task starts
+        if self._commit_task is None:
+            self._commit_task = asyncio.ensure_future(self._commit())
+            self._commit_task.add_done_callback(self._commit_done)
+
+    def _commit_done(self, task: asyncio.Task):
+        self._commit_task = None
+        # Changes that arrived during a successful commit are written right away,
+        # after a failed one they wait for the next persistence run
+        if not task.cancelled() and task.result() and (self._pending_user_data or self._pending_conversations):
+            self._schedule_commit()
+
+    async def _commit(self) -> bool:
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not user_data and not conversations:
+            return True
+
+        if await async_database.run(database.save_persistence, user_data, conversations):
+            return True
+
+        logger.warning("Состояние диалогов не сохранено, повтор при следующем сохранении")
+        # Keep the changes for the next run unless newer ones arrived meanwhile
+        for user_id, data in user_data.items():
+            self._pending_user_data.setdefault(user_id, data)
+        for key, state in conversations.items():
+            self._pending_conversations.setdefault(key, state)
+        return False
+
+    # Chat, bot and callback data are not stored
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
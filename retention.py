@@ -0,0 +1,73 @@
+import logging
+
+import async_database
+import database
+
+logger = logging.getLogger(__name__)
+
+# How often the retention job runs
+RETENTION_INTERVAL = 600  # seconds
+# Questions moved or deleted per transaction
+ARCHIVE_BATCH_SIZE = 500
+# Upper bound on batches per run, the rest waits for the next run
+MAX_BATCHES_PER_RUN = 200
+# Free pages returned to the file system per step, and steps per run
+VACUUM_STEP_PAGES = 256
+MAX_VACUUM_STEPS = 100
+
+
+async def _repeat(func, *args, max_steps: int, shard: int = 0) -> int:
+    """Call a batch function on a shard's DB worker until it has nothing left to do. Returns the total it reported."""
+    total = 0
+    for _ in range(max_steps):
+        # Every batch is queued separately, so live queries and writes get in between batches
+        done = await async_database.run_on(shard, func, *args)
+        if not done:
+            break
+        total += done
+    return total
+
+
+async def _vacuum(schema: str, shard: int = 0) -> int:
+    """Shrink a shard's database file in small steps. Returns the number of pages freed."""
+    freed = 0
+    for _ in range(MAX_VACUUM_STEPS):
+        result = await async_database.run_on(shard, database.incremental_vacuum, VACUUM_STEP_PAGES, schema, shard)
+        if result is None:
+            break
+        step, left = result
+        freed += step
+        if not step or not left:
+            break
+    return freed
+
+
+async def run_retention(archive_file: str, answered_days: int, unanswered_days: int, archive_days: int) -> tuple:
+    """
+    Move questions past their retention window to the archive database, delete archived
+    questions older than archive_days (0 keeps them forever) and shrink both files.
+    All work is done in small batches, shard by shard. Returns (archived, purged, freed pages).
+    """
+    archived = 0
+    for shard in range(database.shard_count()):
+        archived += await _repeat(
+            database.archive_questions, archive_file, answered_days, unanswered_days, ARCHIVE_BATCH_SIZE, shard,
+            max_steps=MAX_BATCHES_PER_RUN, shard=shard,
+        )
+    purged = 0
+    if archive_days > 0:
+        purged = await _repeat(
+            database.purge_archive, archive_file, archive_days, ARCHIVE_BATCH_SIZE,
+            max_steps=MAX_BATCHES_PER_RUN,
+        )
+
+    freed = 0
+    for shard in range(database.shard_count()):
+        freed += await _vacuum("main", shard)
+    if archive_days > 0:
+        freed += await _vacuum(database.ARCHIVE_SCHEMA)
+
+    if archived or purged or freed:
+        logger.info("Архивировано вопросов: %s, удалено из архива: %s, освобождено страниц: %s",
+                    archived, purged, freed)
+    return archived, purged, freed
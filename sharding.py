@@ -0,0 +1,276 @@
+"""
+Offline rebalancing of questions between shard files, for changing SHARD_COUNT.
+
+Questions live in bucket to_user_id % NUM_BUCKETS on shard bucket % shard count, and their
+ids end in their bucket (see database._next_id). Rebalancing moves every bucket whose shard
+changes, with its answers and media references, to its new shard, and gives questions
+created before sharding, whose ids don't end in their bucket, new ids. Counters stay where
+they are, as a user's counters are the sum over all shards, except on shards that are
+dropped, which are added to shard 0.
+
+Every bucket is moved in one transaction over both files. The shard files are switched to
+rollback journals meanwhile, so these commits are atomic, and back to WAL at the end.
+An interrupted rebalance is finished by running the same command again, and the bot
+refuses to start until it is.
+
+Stop the bot first. Buttons in messages sent before about questions that get new ids
+stop working.
+
+Usage: python -m sharding --database users.db --from 1 --to 4
+"""
+import argparse
+import logging
+import sqlite3
+import time
+
+import database
+import logging_setup
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# Bucket of a recipient in SQL, kept non-negative like Python's % in database.bucket_of_user
+BUCKET_SQL = f"((to_user_id % {database.NUM_BUCKETS} + {database.NUM_BUCKETS}) % {database.NUM_BUCKETS})"
+
+
+def _connect(database_file: str) -> sqlite3.Connection:
+    return sqlite3.connect(database_file, isolation_level=None, timeout=database.BUSY_TIMEOUT_MS / 1000)
+
+
+def _prepare(database_file: str, old_count: int, new_count: int) -> int:
+    """
+    Bring every shard file to the latest schema, check the recorded layout and mark the
+    rebalance as started. Returns the first id sequence free on every shard.
+    """
+    files = database.shard_files(database_file, max(old_count, new_count))
+    database.set_database_file(database_file, len(files))
+    try:
+        for shard in range(len(files)):
+            database.enable_incremental_vacuum(shard=shard)
+            report = migrations.migrate(shard=shard)
+            migrations._run_backfills_now(report, shard)
+
+        with database.transaction() as cursor:
+            row = cursor.execute("SELECT shard_count, rebalance_to FROM shard_layout").fetchone()
+            shard_count, rebalance_to = row if row else (1, None)
+            if rebalance_to not in (None, new_count):
+                raise ValueError(f"Не завершено перераспределение с {shard_count} на {rebalance_to} шардов")
+            if shard_count != old_count:
+                raise ValueError(f"База данных разбита на {shard_count} шардов, а не на {old_count}")
+            cursor.execute("DELETE FROM shard_layout")
+            cursor.execute(
+                "INSERT INTO shard_layout (shard_count, rebalance_to) VALUES (?, ?)", (old_count, new_count)
+            )
+
+        last_id = max(
+            database.get_connection(shard).execute(
+                "SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name IN ('questions', 'answers')"
+            ).fetchone()[0]
+            for shard in range(len(files))
+        )
+    finally:
+        database.close_connections()
+    return last_id // database.NUM_BUCKETS + 1
+
+
+def _set_journal_mode(files: list, mode: str):
+    for database_file in files:
+        connection = _connect(database_file)
+        try:
+            connection.execute(f"PRAGMA journal_mode={mode}")
+        finally:
+            connection.close()
+
+
+def _move_bucket(connection: sqlite3.Connection, bucket: int, base: int, target: str) -> tuple:
+    """
+    Move the planned questions of a bucket from the main database to the target schema,
+    which is "main" itself when only ids change. Returns (questions moved, questions renumbered).
+    """
+    nb = database.NUM_BUCKETS
+    cursor = connection.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("DELETE FROM temp.moved")
+        cursor.execute(f'''
+            INSERT INTO temp.moved (old_id, new_id)
+            SELECT old_id, CASE WHEN old_id % {nb} = :bucket THEN old_id
+                                ELSE (:base + row_number() OVER (ORDER BY old_id)) * {nb} + :bucket END
+            FROM temp.plan WHERE bucket = :bucket
+        ''', {"bucket": bucket, "base": base})
+        moved, renumbered, last_id = cursor.execute(
+            "SELECT count(*), sum(old_id != new_id), max(new_id) FROM temp.moved"
+        ).fetchone()
+
+        if target != "main":
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO {target}.media (file_unique_id, media_type, file_id)
+                SELECT file_unique_id, media_type, file_id FROM main.media WHERE file_unique_id IN (
+                    SELECT q.file_unique_id FROM main.questions q JOIN temp.moved m ON q.question_id = m.old_id
+                    UNION
+                    SELECT a.file_unique_id FROM main.answers a JOIN temp.moved m ON a.question_id = m.old_id
+                )
+            ''')
+        cursor.execute(f'''
+            INSERT INTO {target}.questions
+                (question_id, from_user_id, to_user_id, question_text, created_at, is_answered, file_unique_id)
+            SELECT m.new_id, q.from_user_id, q.to_user_id, q.question_text, q.created_at, q.is_answered, q.file_unique_id
+            FROM temp.moved m JOIN main.questions q ON q.question_id = m.old_id
+        ''')
+        # Answers keep their ids. They are set aside and removed before being inserted again,
+        # as within one file the old rows still hold those ids.
+        cursor.execute("DELETE FROM temp.moved_answers")
+        cursor.execute('''
+            INSERT INTO temp.moved_answers (answer_id, question_id, answer_text, created_at, file_unique_id)
+            SELECT a.answer_id, m.new_id, a.answer_text, a.created_at, a.file_unique_id
+            FROM temp.moved m JOIN main.answers a ON a.question_id = m.old_id
+        ''')
+        # Questions go first, so the answer triggers find no search index rows left to update
+        cursor.execute("DELETE FROM main.questions WHERE question_id IN (SELECT old_id FROM temp.moved)")
+        cursor.execute("DELETE FROM main.answers WHERE question_id IN (SELECT old_id FROM temp.moved)")
+        cursor.execute(f'''
+            INSERT INTO {target}.answers (answer_id, question_id, answer_text, created_at, file_unique_id)
+            SELECT answer_id, question_id, answer_text, created_at, file_unique_id FROM temp.moved_answers
+        ''')
+
+        # The bucket's sequence goes along and continues past every id in it
+        cursor.execute(f'''
+            INSERT INTO {target}.bucket_sequences (bucket, last_seq)
+            VALUES (:bucket, max(:last_seq, coalesce(
+                (SELECT last_seq FROM main.bucket_sequences WHERE bucket = :bucket), 0
+            )))
+            ON CONFLICT (bucket) DO UPDATE SET last_seq = max(last_seq, excluded.last_seq)
+        ''', {"bucket": bucket, "last_seq": last_id // nb})
+        if target != "main":
+            cursor.execute("DELETE FROM main.bucket_sequences WHERE bucket = ?", (bucket,))
+        cursor.execute("COMMIT")
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    return moved, renumbered
+
+
+def _rebalance_shard(files: list, shard: int, new_count: int, base: int) -> tuple:
+    """Move the questions of one source shard that belong elsewhere or need new ids. Returns (moved, renumbered)."""
+    connection = _connect(files[shard])
+    moved = renumbered = 0
+    try:
+        connection.execute("CREATE TEMP TABLE moved (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+        connection.execute('''
+            CREATE TEMP TABLE moved_answers (
+                answer_id INTEGER PRIMARY KEY, question_id INTEGER, answer_text TEXT,
+                created_at TIMESTAMP, file_unique_id TEXT
+            )
+        ''')
+        # One pass over the shard plans every bucket, rather than a scan per bucket
+        connection.execute(f'''
+            CREATE TEMP TABLE plan AS
+            SELECT question_id AS old_id, {BUCKET_SQL} AS bucket FROM main.questions
+            WHERE to_user_id IS NOT NULL
+              AND ({BUCKET_SQL} % ? != ? OR question_id % {database.NUM_BUCKETS} != {BUCKET_SQL})
+        ''', (new_count, shard))
+        connection.execute("CREATE INDEX temp.idx_plan_bucket ON plan (bucket)")
+        buckets = [row[0] for row in connection.execute("SELECT DISTINCT bucket FROM temp.plan ORDER BY bucket")]
+
+        for target in range(new_count):
+            target_buckets = [bucket for bucket in buckets if bucket % new_count == target]
+            if not target_buckets:
+                continue
+            schema = "main"
+            if target != shard:
+                schema = "target"
+                connection.execute(f"ATTACH DATABASE ? AS {schema}", (files[target],))
+            try:
+                for bucket in target_buckets:
+                    bucket_moved, bucket_renumbered = _move_bucket(connection, bucket, base, schema)
+                    moved += bucket_moved
+                    renumbered += bucket_renumbered
+            finally:
+                if schema != "main":
+                    connection.execute(f"DETACH DATABASE {schema}")
+    finally:
+        connection.close()
+    return moved, renumbered
+
+
+def _finish(files: list, new_count: int, base: int):
+    """Start every bucket's ids past the old ones, fold counters of dropped shards into shard 0 and record the layout."""
+    for shard in range(new_count):
+        connection = _connect(files[shard])
+        try:
+            connection.executemany('''
+                INSERT INTO bucket_sequences (bucket, last_seq) VALUES (?, ?)
+                ON CONFLICT (bucket) DO UPDATE SET last_seq = max(last_seq, excluded.last_seq)
+            ''', [(bucket, base) for bucket in range(shard, database.NUM_BUCKETS, new_count)])
+        finally:
+            connection.close()
+
+    connection = _connect(files[0])
+    try:
+        for database_file in files[new_count:]:
+            connection.execute("ATTACH DATABASE ? AS dropped", (database_file,))
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute('''
+                    INSERT INTO main.user_counters (user_id, received, unanswered, answered, asked)
+                    SELECT user_id, received, unanswered, answered, asked FROM dropped.user_counters WHERE true
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        received = received + excluded.received, unanswered = unanswered + excluded.unanswered,
+                        answered = answered + excluded.answered, asked = asked + excluded.asked
+                ''')
+                connection.execute("DELETE FROM dropped.user_counters")
+                connection.execute("COMMIT")
+            finally:
+                connection.execute("DETACH DATABASE dropped")
+
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("DELETE FROM shard_layout")
+        connection.execute("INSERT INTO shard_layout (shard_count) VALUES (?)", (new_count,))
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+def rebalance(database_file: str, old_count: int, new_count: int) -> dict:
+    """Spread the questions of a database laid out for old_count shards over new_count shards."""
+    for count in (old_count, new_count):
+        if not 1 <= count <= database.NUM_BUCKETS:
+            raise ValueError(f"Число шардов должно быть от 1 до {database.NUM_BUCKETS}")
+
+    base = _prepare(database_file, old_count, new_count)
+    files = database.shard_files(database_file, max(old_count, new_count))
+    _set_journal_mode(files, "DELETE")
+    try:
+        moved = renumbered = 0
+        for shard in range(len(files)):
+            started = time.perf_counter()
+            shard_moved, shard_renumbered = _rebalance_shard(files, shard, new_count, base)
+            moved += shard_moved
+            renumbered += shard_renumbered
+            logger.info("Шард %s: перенесено вопросов %s, из них с новыми ID %s, за %.1f с",
+                        shard, shard_moved, shard_renumbered, time.perf_counter() - started)
+        _finish(files, new_count, base)
+    finally:
+        _set_journal_mode(files, "WAL")
+    return {"moved": moved, "renumbered": renumbered, "dropped": files[new_count:]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move questions between shard files after changing SHARD_COUNT.")
+    parser.add_argument("--database", default=database.DATABASE_FILE)
+    parser.add_argument("--from", dest="old_count", type=int, required=True, help="shard count the data is laid out for")
+    parser.add_argument("--to", dest="new_count", type=int, required=True, help="new shard count")
+    args = parser.parse_args()
+
+    logging_setup.setup_logging()
+    started = time.perf_counter()
+    result = rebalance(args.database, args.old_count, args.new_count)
+    print(f"Moved {result['moved']} questions, {result['renumbered']} of them got new ids, "
+          f"in {time.perf_counter() - started:.1f} s")
+    if result["dropped"]:
+        print("No longer used, can be deleted: " + ", ".join(result["dropped"]))
+    print(f"Start the bot with SHARD_COUNT={args.new_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates handled at the same time. Each user's updates still run one after another.
+MAX_CONCURRENT_UPDATES = 64
+# Updates taken from the queue and not finished yet, including those waiting for
+# their user's earlier updates. Past this the queue stops handing out updates.
+MAX_PENDING_UPDATES = 1000
+# Updates received but not taken yet. A full queue makes the updater or the
+# webhook wait, so further updates stay on Telegram's side.
+UPDATE_QUEUE_SIZE = 1000
+
+
+class _KeyLock:
+    __slots__ = ("lock", "waiting")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently, up to max_concurrent at a time,
+    while every user's updates run strictly in the order they were received, as the
+    ConversationHandler and user_data expect. Updates without a user are ordered by chat.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_UPDATES, max_pending: int = MAX_PENDING_UPDATES):
+        # The library's own semaphore only bounds updates waiting here. The concurrency limit
+        # is taken after the user's lock, so a user's queued updates hold no slots meanwhile.
+        super().__init__(max_pending)
+        self.max_concurrent = max_concurrent
+        self._running = None
+        self._admitted = None
+        self._pending = 0
+        self._keys = {}
+
+    async def initialize(self) -> None:
+        self._running = asyncio.Semaphore(self.max_concurrent)
+        self._admitted = asyncio.Semaphore(self.max_concurrent_updates)
+        self._pending = 0
+        self._keys = {}
+
+    async def shutdown(self) -> None:
+        """Nothing to free, updates still running are awaited by the application."""
+
+    async def admit(self):
+        """Wait until fewer than max_pending updates are in progress. Called by UpdateQueue.get."""
+        await self._admitted.acquire()
+        self._pending += 1
+
+    def release(self):
+        """Mark an admitted update as finished."""
+        self._pending -= 1
+        self._admitted.release()
+
+    def pending(self) -> int:
+        """Number of updates taken from the queue and not finished yet."""
+        return self._pending
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        try:
+            key = _ordering_key(update)
+            if key is None:
+                async with self._running:
+                    await coroutine
+                return
+
+            # Updates reach this point in the order they left the queue, and asyncio locks
+            # are handed over first come, first served, which keeps each user's order
+            entry = self._keys.get(key)
+            if entry is None:
+                entry = self._keys[key] = _KeyLock()
+            entry.waiting += 1
+            try:
+                async with entry.lock:
+                    async with self._running:
+                        await coroutine
+            finally:
+                entry.waiting -= 1
+                if not entry.waiting:
+                    del self._keys[key]
+        finally:
+            if isinstance(update, Update):
+                self.release()
+
+
+def _ordering_key(update: object):
+    """User id, or chat id for updates without a user, or None for updates that need no ordering."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return ("chat", update.effective_chat.id)
+    return None
+
+
+class UpdateQueue(asyncio.Queue):
+    """
+    Bounded update queue that hands out updates only while the processor has room.
+    When the bot falls behind, the queue fills up and put() makes the updater stop
+    polling or the webhook wait, instead of piling updates up in memory.
+    """
+
+    def __init__(self, processor: UserOrderedUpdateProcessor, maxsize: int = UPDATE_QUEUE_SIZE):
+        super().__init__(maxsize)
+        self.processor = processor
+
+    async def get(self):
+        await self.processor.admit()
+        try:
+            item = await super().get()
+        except BaseException:
+            self.processor.release()
+            raise
+        # Only updates are released by the processor, e.g. the application's stop signal isn't
+        if not isinstance(item, Update):
+            self.processor.release()
+        return item
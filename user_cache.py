@@ -0,0 +1,125 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import database
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = 10000
+USER_FLUSH_BATCH = 100
+USER_FLUSH_INTERVAL = 5  # seconds
+
+_MISSING = object()
+
+
+class UserCache:
+    """
+    Bounded LRU cache in front of the users table.
+    Rows are (user_id, username, created_at) tuples as returned by database.get_user,
+    or None for users known to be absent. Changes are kept as pending upserts and
+    written behind in batches by flush().
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, flush_batch: int = USER_FLUSH_BATCH):
+        self.max_size = max_size
+        self.flush_batch = flush_batch
+        self._rows = OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+
+    def peek(self, user_id: int):
+        """Look a user up in memory only. Returns (hit, row)."""
+        with self._lock:
+            row = self._rows.get(user_id, _MISSING)
+            if row is _MISSING:
+                return False, None
+            self._rows.move_to_end(user_id)
+            return True, row
+
+    def get(self, user_id: int):
+        """Return the user's row, loading it from the database on a cache miss."""
+        hit, row = self.peek(user_id)
+        if hit:
+            return row
+        return self._store_loaded(user_id, database.get_user(user_id))
+
+    def touch(self, user_id: int, username: str) -> bool:
+        """
+        Record that a user exists, optionally with a username.
+        Returns True if this changed anything that has to be written to the database.
+        """
+        with self._lock:
+            row = self._rows.get(user_id, _MISSING)
+            if row is not _MISSING and row is not None and (username is None or row[1] == username):
+                self._rows.move_to_end(user_id)
+                return False
+
+            if row is not _MISSING and row is not None:
+                self._put((user_id, username, row[2]))
+            elif row is None or username is not None:
+                # The stored username after the upsert is known, created_at is not yet
+                self._put((user_id, username, None))
+
+            if username is not None or user_id not in self._dirty:
+                self._dirty[user_id] = username
+            return True
+
+    def needs_flush(self) -> bool:
+        """Whether enough changes are pending to flush them right away."""
+        with self._lock:
+            return len(self._dirty) >= self.flush_batch
+
+    def flush(self) -> int:
+        """Write pending changes in one batched upsert. Returns the number of rows written."""
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+        if not batch:
+            return 0
+
+        rows = database.upsert_users(list(batch.items()))
+        with self._lock:
+            if rows is None:
+                logger.warning("Не удалось записать пользователей, %s изменений отложено", len(batch))
+                # Keep the changes for the next flush, newer usernames win
+                for user_id, username in batch.items():
+                    if self._dirty.get(user_id) is None:
+                        self._dirty[user_id] = username
+                return 0
+
+            for row in rows:
+                if row[0] not in self._dirty:
+                    self._put(tuple(row))
+        return len(rows)
+
+    def _store_loaded(self, user_id: int, row):
+        """Cache a row loaded from the database, merging any pending change."""
+        with self._lock:
+            cached = self._rows.get(user_id, _MISSING)
+            if cached is not _MISSING:
+                return cached
+
+            pending = self._dirty.get(user_id, _MISSING)
+            if pending is not _MISSING:
+                if row is None:
+                    row = (user_id, pending, None)
+                elif pending is not None:
+                    row = (user_id, pending, row[2])
+
+            self._rows[user_id] = row
+            self._evict()
+            return row
+
+    def _put(self, row):
+        """Insert or refresh a row as most recently used. Caller holds the lock."""
+        self._rows[row[0]] = row
+        self._rows.move_to_end(row[0])
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used rows over the size limit. Caller holds the lock."""
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+
+
+registry = UserCache()